@@ -0,0 +1,98 @@
+"""An asyncio interface to the toolbox calls to the server, so that many images can be read, fetched and
+annotated concurrently from a notebook instead of waiting on the network one call at a time.
+eg:
+    async with AsyncConnection(conn, max_concurrency=8) as aconn:
+        images = await aconn.gather(*[aconn.get_image(image_id) for image_id in image_ids])
+        intensities = await aconn.map(aconn.get_intensities, images, c_range=0)
+
+The blocking toolbox functions run in a thread pool. A semaphore bounds the calls in flight so that
+gathering thousands of calls does not queue them all at once. If a toolbox.ConnectionPool is given
+instead of a connection, every call checks out its own connection from the pool.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import toolbox
+
+
+class AsyncConnection(object):
+    def __init__(self, connection, max_concurrency=4):
+        self.connection = connection
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+
+    async def run(self, function, *args, **kwargs):
+        """Runs a blocking function in the thread pool and returns its result"""
+        if self._semaphore is None:  # Created here so that it belongs to the running loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                    partial(function, *args, **kwargs))
+
+    def _with_connection(self, function, *args, **kwargs):
+        if isinstance(self.connection, toolbox.ConnectionPool):
+            with self.connection.connection() as conn:
+                return function(conn, *args, **kwargs)
+        return function(self.connection, *args, **kwargs)
+
+    async def run_with_connection(self, function, *args, **kwargs):
+        """Runs a blocking function taking a connection as first argument in the thread pool"""
+        return await self.run(self._with_connection, function, *args, **kwargs)
+
+    @staticmethod
+    async def gather(*awaitables):
+        """Waits for all the awaitables and returns their results in the same order"""
+        return list(await asyncio.gather(*awaitables))
+
+    async def map(self, coroutine_function, items, *args, **kwargs):
+        """Calls coroutine_function(item, *args, **kwargs) for all items concurrently and returns the
+        results in the order of items"""
+        return await self.gather(*[coroutine_function(item, *args, **kwargs) for item in items])
+
+    ########## Metadata ##########
+
+    async def get_image(self, image_id):
+        return await self.run_with_connection(toolbox.get_image, image_id)
+
+    async def get_dataset(self, dataset_id):
+        return await self.run_with_connection(toolbox.get_dataset, dataset_id)
+
+    async def get_project(self, project_id):
+        return await self.run_with_connection(toolbox.get_project, project_id)
+
+    async def get_dataset_images(self, dataset):
+        return await self.run(lambda: list(toolbox.get_dataset_images(dataset)))
+
+    ########## Pixels ##########
+
+    async def get_intensities(self, image, **kwargs):
+        """See toolbox.get_intensities"""
+        return await self.run(toolbox.get_intensities, image, **kwargs)
+
+    ########## Annotations and rois ##########
+
+    async def create_annotation_map(self, annotation, client_editable=True):
+        return await self.run_with_connection(toolbox.create_annotation_map, annotation, client_editable)
+
+    async def link_annotation(self, object_wrapper, annotation_wrapper):
+        return await self.run(toolbox.link_annotation, object_wrapper, annotation_wrapper)
+
+    async def create_roi(self, image, shapes):
+        return await self.run_with_connection(toolbox.create_roi, image, shapes)
+
+    async def create_rois(self, image, shapes, batch_size=1000):
+        return await self.run_with_connection(toolbox.create_rois, image, shapes, batch_size)
+
+    ########## Lifecycle ##########
+
+    def close(self):
+        """Waits for the calls in flight and stops the thread pool. The connection is not closed"""
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
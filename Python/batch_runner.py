@@ -0,0 +1,186 @@
+"""Runs an image analysis over many images, overlapping the download of the pixels with the analysis
+and spreading the analysis over several processes. Used to run the spots analysis of FindCentroids.ipynb
+over whole datasets."""
+
+import os
+import json
+import logging
+import pickle
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+import toolbox
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_job_id(job_id):
+    """json returns tuples as lists: job ids are compared as tuples"""
+    return tuple(_normalize_job_id(i) for i in job_id) if isinstance(job_id, (list, tuple)) else job_id
+
+
+def _load_state(state_path):
+    if state_path is None or not os.path.exists(state_path):
+        return set()
+    completed = set()
+    line = '\n'
+    with open(state_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                completed.add(_normalize_job_id(json.loads(line)))
+            except ValueError:  # The last line of a run interrupted while saving it
+                logger.warning(f'Skipping the invalid line {line!r} of {state_path}')
+    if not line.endswith('\n'):
+        with open(state_path, 'a') as f:
+            f.write('\n')  # So that the next id is not appended to the interrupted line
+    return completed
+
+
+def _save_state(state_path, job_id):
+    if state_path is None:
+        return
+    with open(state_path, 'a') as f:
+        f.write(json.dumps(_normalize_job_id(job_id)) + '\n')
+
+
+def run_batch(jobs, fetch, analyze, sink, workers=4, fetch_workers=1, prefetch=2, state_path=None):
+    """Runs analyze over the data returned by fetch for every job and passes the results to sink as jobs complete.
+
+    - jobs: an iterable of (job_id, job). job_id must be json serializable.
+    - fetch(job): returns the data to analyze. Runs in fetch_workers threads of the calling process so
+      it can use the connection to OMERO.
+    - analyze(data): returns the result. Runs in a pool of workers processes so it must be a module level
+      function or a functools.partial of one.
+    - sink(job_id, result): called in the calling process as soon as a job completes.
+
+    At most workers + prefetch jobs are fetched and waiting or being analyzed, so memory stays bounded.
+    If a state_path is provided, the ids of the completed jobs are appended to it and skipped
+    when the batch is run again, so an interrupted run can be resumed.
+    A job failing in fetch, analyze or sink is logged and does not stop the other jobs. It is not added to the
+    state, so it is run again when the batch is resumed.
+    Returns the ids of the jobs completed in this run and a dictionary with the exception of every failed job.
+    """
+    completed_before = _load_state(state_path)
+    pending_jobs = iter([(job_id, job) for job_id, job in jobs if _normalize_job_id(job_id) not in completed_before])
+    completed = list()
+    failed = dict()
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, \
+            ProcessPoolExecutor(max_workers=workers) as analysis_pool:
+        fetching = dict()  # future -> job_id
+        analyzing = dict()  # future -> job_id
+
+        def submit_fetches():
+            while len(fetching) + len(analyzing) < workers + prefetch:
+                try:
+                    job_id, job = next(pending_jobs)
+                except StopIteration:
+                    return
+                fetching[fetch_pool.submit(fetch, job)] = job_id
+
+        submit_fetches()
+        while fetching or analyzing:
+            done, _ = wait(list(fetching) + list(analyzing), return_when=FIRST_COMPLETED)
+            for future in done:
+                fetched = future in fetching
+                job_id = fetching.pop(future) if fetched else analyzing.pop(future)
+                try:
+                    if fetched:
+                        analyzing[analysis_pool.submit(analyze, future.result())] = job_id
+                        continue
+                    sink(job_id, future.result())
+                except Exception as e:
+                    logger.error(f'Job {job_id} failed: {e!r}')
+                    failed[job_id] = e
+                    continue
+                _save_state(state_path, job_id)
+                completed.append(job_id)
+            submit_fetches()
+
+    return completed, failed
+
+
+class LocalFileSink(object):
+    """A sink saving the result of every job as a pickle file named after the job id in directory"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.pkl')
+
+    def __call__(self, job_id, result):
+        temp_path = self.path(job_id) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(temp_path, self.path(job_id))
+
+    def load(self, job_id):
+        with open(self.path(job_id), 'rb') as f:
+            return pickle.load(f)
+
+
+########## The spots analysis of FindCentroids.ipynb ##########
+
+def spots_jobs(raw_images, prob_images):
+    """Returns the jobs for run_batch from a list of raw images and a list with, for every raw image,
+    the list of its probability images (the first one being the nuclei probabilities)"""
+    return [(raw_image.getId(), (raw_image, prob_image_list))
+            for raw_image, prob_image_list in zip(raw_images, prob_images)]
+
+
+def fetch_spots_image(job, workers=1):
+    """Fetches the pixels needed to analyze a raw image and its probability images"""
+    raw_image, prob_image_list = job
+    data = {'pixel_size': toolbox.get_pixel_sizes(raw_image),
+            'prob_channels': list(),
+            'raw_channels': list()}
+    for ch_nr, ch_prob in enumerate(prob_image_list[1:]):
+        ch_prob_data = toolbox.get_intensities(ch_prob, c_range=0, workers=workers)
+        data['prob_channels'].append(ch_prob_data.astype('float16', casting='same_kind').squeeze())
+        data['raw_channels'].append(toolbox.get_intensities(raw_image, c_range=(1 + ch_nr), workers=workers).squeeze())
+
+    return data
+
+
+def analyze_spots_image(data, up_thresholds, low_thresholds, size_thresholds, min_distance):
+    """Segments the spots in every channel, measures them and computes the distances between channels"""
+    spots_props = list()
+    for ch_nr, (ch_prob_data, raw_data) in enumerate(zip(data['prob_channels'], data['raw_channels'])):
+        labels = toolbox.segment_channel(channel=ch_prob_data,
+                                         min_distance=1,
+                                         sigma=None,
+                                         method='hysteresis',
+                                         hysteresis_levels=(low_thresholds[ch_nr], up_thresholds[ch_nr]))
+        spots_props_channel = toolbox.compute_channel_spots_measurements(channel=raw_data,
+                                                                         label_channel=labels)
+        # We filter out the spots that are too small
+        spots_props.append(spots_props_channel[spots_props_channel['area'] >= size_thresholds[ch_nr]])
+
+    spots_pos = [ch_props['weighted_centroid'] for ch_props in spots_props]
+    distances = toolbox.compute_distances_matrix(positions=spots_pos,
+                                                 sigma=min_distance,
+                                                 pixel_size=data['pixel_size'],
+                                                 remove_mcn=True)
+
+    return {'spots_properties': spots_props, 'distances': distances}
+
+
+def run_spots_batch(raw_images, prob_images, sink, up_thresholds, low_thresholds, size_thresholds, min_distance,
+                    workers=4, fetch_workers=1, prefetch=2, state_path=None):
+    """Runs the spots analysis over every raw image and its probability images. See run_batch"""
+    analyze = partial(analyze_spots_image,
+                      up_thresholds=up_thresholds,
+                      low_thresholds=low_thresholds,
+                      size_thresholds=size_thresholds,
+                      min_distance=min_distance)
+
+    return run_batch(jobs=spots_jobs(raw_images, prob_images),
+                     fetch=fetch_spots_image,
+                     analyze=analyze,
+                     sink=sink,
+                     workers=workers,
+                     fetch_workers=fetch_workers,
+                     prefetch=prefetch,
+                     state_path=state_path)
@@ -0,0 +1,209 @@
+"""Benchmarks of the toolbox hot paths against the fake connection of fake_gateway.
+
+Every case reports the best wall time over a number of repeats and the peak memory allocated
+(traced with tracemalloc, which includes numpy buffers, in a separate run). Results are appended with the current git
+commit to a JSON lines file so that they can be compared across commits.
+eg:
+    python benchmark.py --latency 0.005 --bandwidth 100e6 --output benchmarks.jsonl
+    python benchmark.py --filter distances --compare benchmarks.jsonl
+"""
+
+import argparse
+import gc
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import toolbox
+from fake_gateway import FakeConnection, synthetic_spots
+
+CASES = dict()
+
+
+def case(function):
+    """Registers a benchmark case. A case receives the benchmark options and returns the function to time"""
+    CASES[function.__name__] = function
+    return function
+
+
+def measure(function, repeat=3):
+    """Returns the best wall time over repeat runs and the peak traced memory of a run in bytes.
+    The timed runs are not traced, as tracemalloc slows down the allocations: the memory is measured
+    in one more run"""
+    times = list()
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+
+########## Cases ##########
+
+def _spots_image(options, size_c=1):
+    conn = FakeConnection(latency=options.latency, bandwidth=options.bandwidth)
+    volume, _ = synthetic_spots(shape=options.volume_shape, nr_spots=options.nr_spots)
+    data = np.stack([(volume * 4095).astype(np.uint16)] * size_c, axis=1)[:, :, np.newaxis]  # zctyx
+    return conn, conn.new_image(data)
+
+
+@case
+def get_intensities_serial(options):
+    _, image = _spots_image(options, size_c=2)
+    return lambda: toolbox.get_intensities(image, c_range=1)
+
+
+@case
+def get_intensities_parallel(options):
+    _, image = _spots_image(options, size_c=2)
+    return lambda: toolbox.get_intensities(image, c_range=1, workers=options.workers)
+
+
+@case
+def segment_channel(options):
+    volume, _ = synthetic_spots(shape=options.volume_shape, nr_spots=options.nr_spots)
+    return lambda: toolbox.segment_channel(volume, min_distance=1, sigma=None, method='hysteresis',
+                                           hysteresis_levels=(.3, .6))
+
+
+@case
+def segment_channel_blocked(options):
+    volume, _ = synthetic_spots(shape=options.volume_shape, nr_spots=options.nr_spots)
+    block_shape = tuple(max(1, s // 2) for s in volume.shape)
+    return lambda: toolbox.segment_channel(volume, min_distance=1, sigma=None, method='hysteresis',
+                                           hysteresis_levels=(.3, .6), block_shape=block_shape,
+                                           workers=options.workers)
+
+
+@case
+def compute_channel_spots_properties(options):
+    volume, _ = synthetic_spots(shape=options.volume_shape, nr_spots=options.nr_spots)
+    labels = toolbox.segment_channel(volume, min_distance=1, sigma=None, method='hysteresis',
+                                     hysteresis_levels=(.3, .6))
+    return lambda: toolbox.compute_channel_spots_properties(volume, labels, pixel_size=(.1, .1, .3))
+
+
+@case
+def compute_distances_matrix(options):
+    rng = np.random.default_rng(0)
+    positions = [rng.uniform(0, 256, size=(options.nr_spots * 10, 3)) for _ in range(3)]
+    return lambda: toolbox.compute_distances_matrix(positions, sigma=2, pixel_size=(.1, .1, .3))
+
+
+@case
+def compute_distances_matrix_cdist(options):
+    rng = np.random.default_rng(0)
+    positions = [rng.uniform(0, 256, size=(options.nr_spots * 10, 3)) for _ in range(3)]
+    return lambda: toolbox.compute_distances_matrix(positions, sigma=2, pixel_size=(.1, .1, .3), method='cdist')
+
+
+def _table_values(nr_rows):
+    rng = np.random.default_rng(0)
+    return [np.arange(nr_rows), rng.random(nr_rows), rng.random(nr_rows) > .5,
+            np.array([f'spot_{i}' for i in range(nr_rows)])]
+
+
+@case
+def create_annotation_table(options):
+    conn = FakeConnection(latency=options.latency, bandwidth=options.bandwidth)
+    values = _table_values(options.nr_rows)
+    return lambda: toolbox.create_annotation_table(conn, 'benchmark', ['id', 'value', 'flag', 'name'],
+                                                   ['', '', '', ''], values)
+
+
+@case
+def create_annotation_table_streaming(options):
+    conn = FakeConnection(latency=options.latency, bandwidth=options.bandwidth)
+    values = _table_values(options.nr_rows)
+    return lambda: toolbox.create_annotation_table_streaming(conn, 'benchmark', ['id', 'value', 'flag', 'name'],
+                                                             ['', '', '', ''], [values])
+
+
+@case
+def create_shapes(options):
+    conn, image = _spots_image(options)
+    rng = np.random.default_rng(0)
+    x, y, z = rng.uniform(0, 256, size=(3, options.nr_rows))
+
+    def create():
+        shapes = toolbox.create_shapes_point(x, y, z.astype(int), 0, fill_colors=(255, 0, 0, 128))
+        return toolbox.create_rois(conn, image, shapes)
+
+    return create
+
+
+########## Runner ##########
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _load_results(path):
+    if not path or not os.path.exists(path):
+        return list()
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run(options):
+    commit = _git_commit()
+    previous = {result['case']: result for result in _load_results(options.compare)}
+    results = list()
+    for name, setup in CASES.items():
+        if options.filter and options.filter not in name:
+            continue
+        seconds, peak = measure(setup(options), repeat=options.repeat)
+        result = {'case': name, 'commit': commit, 'seconds': seconds, 'peak_bytes': peak,
+                  'latency': options.latency, 'bandwidth': options.bandwidth, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        results.append(result)
+
+        line = f'{name:40s} {seconds * 1000:10.1f} ms {peak / 2 ** 20:10.1f} MB'
+        if name in previous:
+            line += (f'   ({previous[name]["seconds"] / seconds:.2f}x faster than {previous[name]["commit"]}, '
+                     f'{peak / max(previous[name]["peak_bytes"], 1):.2f}x memory)')
+        print(line)
+
+    if options.output:
+        with open(options.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    return results
+
+
+def _parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the toolbox against a fake OMERO server')
+    parser.add_argument('--filter', help='Only run the cases containing this string')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every case. The best time is reported')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds per call to the server')
+    parser.add_argument('--bandwidth', type=float, default=100e6, help='Bytes per second from the server')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--volume-shape', type=int, nargs=3, default=(32, 256, 256), help='z y x')
+    parser.add_argument('--nr-spots', type=int, default=200)
+    parser.add_argument('--nr-rows', type=int, default=10000, help='Rows of the tables and number of shapes')
+    parser.add_argument('--output', help='JSON lines file the results are appended to')
+    parser.add_argument('--compare', help='JSON lines file with previous results to compare with')
+
+    options = parser.parse_args(arguments)
+    options.volume_shape = tuple(options.volume_shape)
+    return options
+
+
+if __name__ == '__main__':
+    run(_parse_arguments())
@@ -0,0 +1,390 @@
+"""An in-process stand in for the parts of a BlitzGateway connection used by toolbox, so that the
+toolbox can be benchmarked without a server. Every call to the fake server sleeps for latency seconds
+plus the time to transfer its payload at bandwidth bytes per second."""
+
+import itertools
+import threading
+import time
+from functools import partial
+import numpy as np
+from omero import model
+from omero.rtypes import rlong
+
+
+class FakeServer(object):
+    """Simulates the cost of the calls to the server and counts them"""
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.calls = 0
+        self.bytes = 0
+
+    def call(self, nbytes=0):
+        with self._lock:
+            self.calls += 1
+            self.bytes += nbytes
+        delay = self.latency + (nbytes / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+
+    def new_id(self):
+        with self._lock:
+            return next(self._ids)
+
+
+class _Value(object):
+    def __init__(self, value, unit=None):
+        self._value = value
+        self._unit = unit
+
+    def getValue(self):
+        return self._value
+
+    def getUnit(self):
+        return self._unit
+
+
+class _Unit(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class _PixelsType(object):
+    def __init__(self, dtype):
+        dtype = np.dtype(dtype)
+        self.value = 'float' if dtype.kind == 'f' else dtype.name
+        self.bitSize = dtype.itemsize * 8
+
+
+class FakePixels(object):
+    """Serves the (y, x) planes and tiles of a zctyx numpy array, as the server does.
+    toolbox.get_intensities returns them as zctxy"""
+    def __init__(self, data, server, pixel_sizes=(1.0, 1.0, 1.0)):
+        self.data = data
+        self.server = server
+        self.pixel_sizes = pixel_sizes
+        self._obj = model.PixelsI(server.new_id(), False)
+
+    def getPixelsType(self):
+        return _PixelsType(self.data.dtype)
+
+    def getPhysicalSizeX(self):
+        return _Value(self.pixel_sizes[0], _Unit('MICROMETER'))
+
+    def getPhysicalSizeY(self):
+        return _Value(self.pixel_sizes[1], _Unit('MICROMETER'))
+
+    def getPhysicalSizeZ(self):
+        return _Value(self.pixel_sizes[2], _Unit('MICROMETER'))
+
+    def getPlane(self, theZ=0, theC=0, theT=0):
+        plane = self.data[theZ, theC, theT]
+        self.server.call(plane.nbytes)
+        return plane.copy()
+
+    def getPlanes(self, zctList):
+        for z, c, t in zctList:
+            yield self.getPlane(z, c, t)
+
+    def getTiles(self, zctTileList):
+        for z, c, t, (x, y, width, height) in zctTileList:
+            tile = self.data[z, c, t, y:y + height, x:x + width]
+            self.server.call(tile.nbytes)
+            yield tile.copy()
+
+
+class _Annotated(object):
+    """Keeps the annotations linked to a fake object"""
+    def linkAnnotation(self, annotation):
+        self.server.call()
+        self.annotations.append(annotation)
+        return annotation
+
+    def listAnnotations(self, ns=None):
+        self.server.call()
+        return [annotation for annotation in self.annotations if ns is None or annotation.getNs() == ns]
+
+
+class FakeImage(_Annotated):
+    """An image wrapper serving the pixels of a zctyx numpy array. See FakePixels"""
+    def __init__(self, data, server, image_id=None, name=None, pixel_sizes=(1.0, 1.0, 1.0)):
+        self.data = data
+        self.server = server
+        self._id = image_id if image_id is not None else server.new_id()
+        self._name = name or f'image_{self._id}'
+        self._pixels = FakePixels(data, server, pixel_sizes)
+        self._obj = model.ImageI(self._id, False)
+        self.annotations = list()
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._name
+
+    def getPrimaryPixels(self):
+        return self._pixels
+
+    def getSizeZ(self):
+        return self.data.shape[0]
+
+    def getSizeC(self):
+        return self.data.shape[1]
+
+    def getSizeT(self):
+        return self.data.shape[2]
+
+    def getSizeY(self):
+        return self.data.shape[3]
+
+    def getSizeX(self):
+        return self.data.shape[4]
+
+
+class FakeDataset(_Annotated):
+    """A dataset wrapper containing fake images"""
+    def __init__(self, server, images=(), dataset_id=None, name=None):
+        self.server = server
+        self._id = dataset_id if dataset_id is not None else server.new_id()
+        self._name = name or f'dataset_{self._id}'
+        self.images = list(images)
+        self._obj = model.DatasetI(self._id, False)
+        self.annotations = list()
+
+    def getId(self):
+        return self._id
+
+    def getName(self):
+        return self._name
+
+    def listChildren(self):
+        self.server.call()
+        return iter(self.images)
+
+
+class FakeTable(object):
+    """An OMERO.tables table keeping the rows in memory"""
+    def __init__(self, server):
+        self.server = server
+        self.columns = None
+        self.nr_rows = 0
+        self._file_id = server.new_id()
+
+    def initialize(self, columns):
+        self.server.call()
+        self.columns = [(column.name, type(column).__name__) for column in columns]
+
+    def addData(self, columns):
+        nr_rows = len(columns[0].values) if columns else 0
+        self.server.call(8 * nr_rows * len(columns))
+        self.nr_rows += nr_rows
+
+    def getOriginalFile(self):
+        self.server.call()
+        return model.OriginalFileI(self._file_id, False)
+
+    def close(self):
+        self.server.call()
+
+
+class _RepositoryDescription(object):
+    def getId(self):
+        return _Value(1)
+
+
+class _Repositories(object):
+    descriptions = [_RepositoryDescription()]
+
+
+class FakeSharedResources(object):
+    def __init__(self, server):
+        self.server = server
+        self.tables = list()
+
+    def repositories(self):
+        self.server.call()
+        return _Repositories()
+
+    def newTable(self, repository_id, table_name):
+        self.server.call()
+        table = FakeTable(self.server)
+        self.tables.append(table)
+        return table
+
+
+class FakeUpdateService(object):
+    """Assigns ids to the objects it saves. The payload is estimated from the number of objects"""
+    def __init__(self, server, object_size=200):
+        self.server = server
+        self.object_size = object_size
+
+    def _save(self, obj):
+        if obj.getId() is None:
+            obj.setId(rlong(self.server.new_id()))
+        return obj
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self.server.call(self.object_size)
+        return self._save(obj)
+
+    def saveAndReturnArray(self, objects, ctx=None):
+        self.server.call(self.object_size * len(objects))
+        return [self._save(obj) for obj in objects]
+
+    def saveArray(self, objects, ctx=None):
+        self.saveAndReturnArray(objects, ctx)
+
+
+class _ServiceOpts(dict):
+    def copy(self):
+        return _ServiceOpts(self)
+
+    def setOmeroGroup(self, group_id):
+        self['omero.group'] = str(group_id)
+
+
+class _ServiceFactory(object):
+    def __init__(self, server):
+        self.shared_resources = FakeSharedResources(server)
+
+    def sharedResources(self):
+        return self.shared_resources
+
+
+class _Client(object):
+    def __init__(self, server):
+        self.sf = _ServiceFactory(server)
+
+
+class FakeConnection(object):
+    """A BlitzGateway connection with an update service and OMERO.tables"""
+    def __init__(self, latency=0.0, bandwidth=None, server=None):
+        self.server = server or FakeServer(latency=latency, bandwidth=bandwidth)
+        self.c = _Client(self.server)
+        self.SERVICE_OPTS = _ServiceOpts()
+        self._update_service = FakeUpdateService(self.server)
+        self.objects = dict()  # (type, id) -> object
+
+    def getObject(self, obj_type, oid=None):
+        self.server.call()
+        return self.objects.get((obj_type, oid))
+
+    def getUpdateService(self):
+        return self._update_service
+
+    def isConnected(self):
+        return True
+
+    def keepAlive(self):
+        self.server.call()
+        return True
+
+    def close(self, hard=True):
+        pass
+
+    def new_image(self, data, **kwargs):
+        """Returns a FakeImage served by this connection from a zctyx array, with planes as (y, x)"""
+        image = FakeImage(data, self.server, **kwargs)
+        self.objects[('Image', image.getId())] = image
+        return image
+
+    def new_dataset(self, images=(), **kwargs):
+        """Returns a FakeDataset of this connection containing images"""
+        dataset = FakeDataset(self.server, images, **kwargs)
+        self.objects[('Dataset', dataset.getId())] = dataset
+        return dataset
+
+
+class FakeSessions(object):
+    """The sessions of a fake server. Counts the logins and the connections joining an existing session.
+    gateway_class() can be passed as the gateway_class of toolbox.ConnectionPool"""
+    def __init__(self, latency=0.0):
+        self.server = FakeServer(latency=latency)
+        self._lock = threading.Lock()
+        self._keys = itertools.count(1)
+        self.active = set()
+        self.logins = 0
+        self.joins = 0
+
+    def login(self):
+        with self._lock:
+            self.logins += 1
+            session_key = f'session_{next(self._keys)}'
+            self.active.add(session_key)
+        return session_key
+
+    def join(self, session_key):
+        with self._lock:
+            if session_key not in self.active:
+                return False
+            self.joins += 1
+        return True
+
+    def kill(self, session_key):
+        with self._lock:
+            self.active.discard(session_key)
+
+    def gateway_class(self):
+        return partial(FakeGateway, self)
+
+
+class _EventContext(object):
+    def __init__(self, session_key):
+        self.sessionUuid = session_key
+
+
+class FakeGateway(FakeConnection):
+    """A connection that logs in, or joins a session, of FakeSessions. Built as the BlitzGateway"""
+    def __init__(self, sessions, username=None, passwd=None, group=None, port=None, host=None, secure=False):
+        super().__init__(server=sessions.server)
+        self.sessions = sessions
+        self.session_key = None
+        self._connected = False
+
+    def connect(self, sUuid=None):
+        self.server.call()
+        if sUuid is None:
+            self.session_key = self.sessions.login()
+        elif self.sessions.join(sUuid):
+            self.session_key = sUuid
+        else:
+            return False
+        self._connected = True
+        return True
+
+    def getEventContext(self):
+        return _EventContext(self.session_key)
+
+    def isConnected(self):
+        return self._connected and self.session_key in self.sessions.active
+
+    def keepAlive(self):
+        self.server.call()
+        return self.isConnected()
+
+    def close(self, hard=True):
+        self._connected = False
+        if hard:
+            self.sessions.kill(self.session_key)
+
+
+def synthetic_spots(shape=(32, 256, 256), nr_spots=200, radius=2.0, noise=0.05, seed=0):
+    """Returns a (z, y, x) float32 volume with nr_spots gaussian spots over a noisy background,
+    and the (z, y, x) positions of the spots"""
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform((0, 0, 0), shape, size=(nr_spots, 3))
+    volume = np.zeros(shape, dtype=np.float32)
+    extent = int(np.ceil(3 * radius))
+    offsets = np.arange(-extent, extent + 1)
+    for position in positions:
+        center = np.round(position).astype(int)
+        slices = tuple(slice(max(0, c - extent), min(s, c + extent + 1)) for c, s in zip(center, shape))
+        grids = np.ix_(*[offsets[sl.start - c + extent:sl.stop - c + extent] + c - p
+                         for sl, c, p in zip(slices, center, position)])
+        volume[slices] += np.exp(-sum(g ** 2 for g in grids) / (2 * radius ** 2))
+    volume += rng.normal(0, noise, size=shape).astype(np.float32)
+    np.clip(volume, 0, 1, out=volume)
+
+    return volume, positions
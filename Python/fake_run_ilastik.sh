@@ -0,0 +1,29 @@
+#!/usr/bin/env bash
+# A stand in for ilastik's run_ilastik.sh to test run_ilastik without ilastik.
+# Writes {input}_Probabilities.npy for every input, as ilastik does by default, with the input scaled to 0-1.
+# Every invocation appends its arguments to $FAKE_ILASTIK_LOG, if set.
+# Inputs with 'fail' in their name are not processed and the script exits with an error.
+
+if [ -n "$FAKE_ILASTIK_LOG" ]; then
+    echo "$@" >> "$FAKE_ILASTIK_LOG"
+fi
+
+status=0
+for argument in "$@"; do
+    case "$argument" in
+        --*) ;;
+        *fail*)
+            echo "Could not process $argument" >&2
+            status=1
+            ;;
+        *)
+            "${PYTHON:-python3}" -c "
+import sys
+import numpy as np
+np.save(sys.argv[1][:-len('.npy')] + '_Probabilities.npy', np.load(sys.argv[1]).astype(np.float32) / 255)
+" "$argument"
+            ;;
+    esac
+done
+
+exit $status
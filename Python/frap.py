@@ -0,0 +1,173 @@
+"""The FRAP analysis of SimpleFRAP.ipynb over many images: mean intensities in an ellipse over time,
+stored as map annotations, and the fit of the fluorescence recovery curves."""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from omero.model import EllipseI
+import toolbox
+
+NAMESPACE = 'demo.simple_frap_data'
+
+
+def get_ellipse(connection, image):
+    """Returns the last ellipse found in the rois of an image or None"""
+    result = connection.getRoiService().findByImage(image.getId(), None)
+    ellipse = None
+    for roi in result.rois:
+        for shape in roi.copyShapes():
+            if type(shape) == EllipseI:
+                ellipse = shape
+
+    return ellipse
+
+
+def get_channel_index(image, label):
+    """Returns the index of the channel with label or 0 if there is none"""
+    labels = image.getChannelLabels()
+    if label in labels:
+        return labels.index(label)
+    return 0
+
+
+def _ellipse_mask(ellipse, x_range, y_range):
+    """Returns an (x, y) boolean mask of the pixels of the region x_range, y_range within the ellipse"""
+    center_x, center_y = ellipse.getX().getValue(), ellipse.getY().getValue()
+    radius_x, radius_y = ellipse.getRadiusX().getValue(), ellipse.getRadiusY().getValue()
+    xx, yy = np.ogrid[x_range[0]:x_range[1], y_range[0]:y_range[1]]
+
+    return ((xx - center_x) / radius_x) ** 2 + ((yy - center_y) / radius_y) ** 2 <= 1
+
+
+def _ellipse_bounds(size, center, radius):
+    return max(0, int(np.floor(center - radius))), min(size, int(np.ceil(center + radius)) + 1)
+
+
+def get_mean_intensities(image, the_c, ellipse, the_z=0, workers=1):
+    """Returns the mean intensity within the ellipse of every time point.
+    Only the bounding box of the ellipse is fetched, for all time points at once, and the means are
+    computed locally. workers are passed to toolbox.get_intensities"""
+    x_range = _ellipse_bounds(image.getSizeX(), ellipse.getX().getValue(), ellipse.getRadiusX().getValue())
+    y_range = _ellipse_bounds(image.getSizeY(), ellipse.getY().getValue(), ellipse.getRadiusY().getValue())
+    intensities = toolbox.get_intensities(image, z_range=the_z, c_range=the_c, x_range=x_range, y_range=y_range,
+                                          workers=workers)
+    planes = intensities.reshape((image.getSizeT(), -1))
+    mask = _ellipse_mask(ellipse, x_range, y_range).ravel()
+
+    # Indexing copies the pixels within the mask, which mean sums as float64 so integer pixels do not overflow
+    return planes[:, mask].mean(axis=1)
+
+
+def get_mean_intensities_server(connection, image, the_c, ellipse, the_z=0, workers=4):
+    """Returns the mean intensity within the ellipse of every time point as computed by the server.
+    The roi service computes the stats of one time point per call, so workers calls are issued at the same time"""
+    roi_service = connection.getRoiService()
+    shape_id = ellipse.getId().getValue()
+
+    def mean(t):
+        stats = roi_service.getShapeStatsRestricted([shape_id], the_z, t, [the_c])[0]
+        return stats.mean[list(stats.channelIds).index(the_c)]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.array(list(executor.map(mean, range(image.getSizeT()))))
+
+
+def save_map_annotations(connection, images, values, namespace=NAMESPACE):
+    """Replaces the annotations in namespace of every image by a map annotation with the values of every
+    time point. See toolbox.create_annotations_map"""
+    return toolbox.create_annotations_map(connection, images,
+                                          [{str(t): value for t, value in enumerate(np.asarray(image_values).tolist())}
+                                           for image_values in values],
+                                          namespace=namespace,
+                                          replace=True)
+
+
+def fit_recovery(times, curves, bleach_index=None, taus=None):
+    """Fits the recovery after bleaching of many curves at once to plateau - amplitude * exp(-(t - t_bleach) / tau).
+    curves is a (curves, time points) array. bleach_index, the time point of every curve right after bleaching,
+    defaults to the minimum of every curve. For every tau in taus (by default 200 values spaced logarithmically
+    over the duration of the series) plateau and amplitude are solved by least squares for all curves together,
+    keeping the tau with the lowest residual.
+    Returns a structured array with the plateau, amplitude, tau, half_time and mobile_fraction of every curve"""
+    times = np.asarray(times, dtype=np.float64)
+    curves = np.atleast_2d(np.asarray(curves, dtype=np.float64))
+    if bleach_index is None:
+        bleach_index = curves.argmin(axis=1)
+    bleach_index = np.broadcast_to(bleach_index, curves.shape[:1])
+    if taus is None:
+        duration = times[-1] - times[0]
+        taus = np.geomspace(duration / 1000, duration * 10, 200)
+
+    elapsed = times[np.newaxis, :] - times[bleach_index][:, np.newaxis]
+    weights = (elapsed >= 0).astype(np.float64)
+    elapsed = np.maximum(elapsed, 0)
+    s1 = weights.sum(axis=1)
+    sy = (weights * curves).sum(axis=1)
+    syy = (weights * curves ** 2).sum(axis=1)
+
+    best = np.full(len(curves), np.inf)
+    fit = np.zeros(len(curves), dtype=[('plateau', np.float64), ('amplitude', np.float64), ('tau', np.float64),
+                                       ('half_time', np.float64), ('mobile_fraction', np.float64)])
+    for tau in taus:
+        e = np.exp(-elapsed / tau) * weights
+        se, see, sey = e.sum(axis=1), (e ** 2).sum(axis=1), (e * curves).sum(axis=1)
+        det = s1 * see - se ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            plateau = (see * sy - se * sey) / det
+            coefficient = (s1 * sey - se * sy) / det
+        residual = syy - plateau * sy - coefficient * sey  # The least squares residual sum of squares
+        better = np.isfinite(residual) & (residual < best)
+        best[better] = residual[better]
+        fit['plateau'][better] = plateau[better]
+        fit['amplitude'][better] = -coefficient[better]
+        fit['tau'][better] = tau
+
+    fit['half_time'] = fit['tau'] * np.log(2)
+    rows = np.arange(len(curves))
+    post_bleach = curves[rows, bleach_index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pre_bleach = np.cumsum(curves, axis=1)[rows, bleach_index - 1] / bleach_index
+        pre_bleach[bleach_index == 0] = np.nan
+        fit['mobile_fraction'] = (fit['plateau'] - post_bleach) / (pre_bleach - post_bleach)
+
+    return fit
+
+
+def _process_image(connection, image, channel_label, method, the_z, fetch_workers):
+    ellipse = get_ellipse(connection, image)
+    if ellipse is None:
+        return None
+    the_c = get_channel_index(image, channel_label)
+    if method == 'local':
+        return get_mean_intensities(image, the_c, ellipse, the_z=the_z, workers=fetch_workers)
+    elif method == 'server':
+        return get_mean_intensities_server(connection, image, the_c, ellipse, the_z=the_z, workers=fetch_workers)
+    else:
+        raise Exception(f'Method {method} is not valid. Use local or server')
+
+
+def run_frap(connection, images, channel_label, namespace=NAMESPACE, method='local', the_z=0, workers=4,
+             fetch_workers=1, save=True):
+    """Measures the mean intensities in the ellipse of every image, workers images at a time,
+    saves them as map annotations and fits the recovery curves.
+    Images without an ellipse are skipped.
+    Returns a dictionary with the mean intensities and a dictionary with the fit of every image id"""
+    images = list(images)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        values = list(executor.map(lambda image: _process_image(connection, image, channel_label, method,
+                                                                the_z, fetch_workers),
+                                   images))
+    measured = [(image, image_values) for image, image_values in zip(images, values) if image_values is not None]
+    if not measured:
+        return dict(), dict()
+
+    if save:
+        save_map_annotations(connection, [image for image, _ in measured], [v for _, v in measured], namespace)
+
+    intensities = {image.getId(): image_values for image, image_values in measured}
+    fits = dict()
+    for size_t in {len(v) for v in intensities.values()}:  # Curves of the same length are fitted together
+        image_ids = [image_id for image_id, v in intensities.items() if len(v) == size_t]
+        fit = fit_recovery(np.arange(size_t), np.stack([intensities[image_id] for image_id in image_ids]))
+        fits.update(zip(image_ids, fit))
+
+    return intensities, fits
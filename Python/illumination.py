@@ -0,0 +1,169 @@
+"""Illumination and background correction of IlluminationCorrectionNotebook.ipynb for whole datasets:
+flat-field profiles estimated over many images, fast top-hat background removal for large radii
+and upload of the corrected images."""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.morphology import disk, white_tophat
+import toolbox
+
+
+def _iter_planes(image, the_c, the_z=None, the_t=None):
+    """Yields the (y, x) planes of a channel of an image. By default all z and t are used"""
+    z_list = range(image.getSizeZ()) if the_z is None else [the_z]
+    t_list = range(image.getSizeT()) if the_t is None else [the_t]
+    zct_list = [(z, the_c, t) for z, t in product(z_list, t_list)]
+
+    return image.getPrimaryPixels().getPlanes(zct_list)
+
+
+def estimate_flatfield(images, the_c, method='mean', the_z=None, the_t=None, sigma=None, max_planes=100):
+    """Estimates the flat-field profile of a channel from all the planes of many images of the same size.
+    With method 'mean' the planes are accumulated one at a time into a running sum. With method 'median'
+    the median of at most max_planes planes, evenly sampled, is computed.
+    The profile is optionally smoothed with a gaussian of sigma pixels and normalized to a mean of 1.
+    Returns a float32 (y, x) array"""
+    if method == 'mean':
+        total = None
+        nr_planes = 0
+        for image in images:
+            for plane in _iter_planes(image, the_c, the_z, the_t):
+                if total is None:
+                    total = np.zeros(plane.shape, dtype=np.float64)
+                total += plane
+                nr_planes += 1
+        if total is None:
+            raise Exception('Could not estimate a flat-field without planes')
+        profile = total / nr_planes
+    elif method == 'median':
+        planes = [(image, z, t)
+                  for image in images
+                  for z in (range(image.getSizeZ()) if the_z is None else [the_z])
+                  for t in (range(image.getSizeT()) if the_t is None else [the_t])]
+        if not planes:
+            raise Exception('Could not estimate a flat-field without planes')
+        sample = np.unique(np.linspace(0, len(planes) - 1, min(max_planes, len(planes))).astype(int))
+        stack = np.stack([image.getPrimaryPixels().getPlane(z, the_c, t) for image, z, t in
+                          (planes[i] for i in sample)])
+        profile = np.median(stack, axis=0)
+    else:
+        raise Exception(f'Method {method} is not valid. Use mean or median')
+
+    profile = profile.astype(np.float32)
+    if sigma:
+        profile = ndi.gaussian_filter(profile, sigma=sigma)
+
+    return profile / profile.mean()
+
+
+def estimate_flatfields(images, method='mean', the_z=None, the_t=None, sigma=None, max_planes=100):
+    """Estimates the flat-field profile of every channel. Returns a float32 (c, y, x) array"""
+    images = list(images)
+    return np.stack([estimate_flatfield(images, the_c, method=method, the_z=the_z, the_t=the_t,
+                                        sigma=sigma, max_planes=max_planes)
+                     for the_c in range(images[0].getSizeC())])
+
+
+def correct_planes(planes, flatfield, background=0, dtype=None):
+    """Corrects a plane or a (..., y, x) stack of planes as (planes - background) / flatfield.
+    The result is clipped to the range of dtype, by default the dtype of the planes"""
+    dtype = np.dtype(dtype or planes.dtype)
+    corrected = np.subtract(planes, background, dtype=np.float32)
+    corrected /= flatfield
+    if np.issubdtype(dtype, np.integer):
+        np.clip(corrected, np.iinfo(dtype).min, np.iinfo(dtype).max, out=corrected)
+        np.rint(corrected, out=corrected)
+
+    return corrected.astype(dtype, copy=False)
+
+
+def _block_min(plane, factor):
+    """Downsamples a plane taking the minimum of every factor x factor block"""
+    size_y, size_x = plane.shape
+    padded = np.pad(plane, ((0, -size_y % factor), (0, -size_x % factor)), mode='edge')
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+
+    return blocks.min(axis=(1, 3))
+
+
+def white_tophat_fast(plane, radius, max_radius=10):
+    """White top-hat with a disk of radius. For radii larger than max_radius the background (the opening)
+    is computed on a copy of the plane downsampled by the minimum of blocks, with a proportionally
+    smaller disk, and upsampled back. The background is kept below the plane so the result is not negative."""
+    factor = int(np.ceil(radius / max_radius))
+    if factor <= 1:
+        return white_tophat(plane, disk(radius))
+
+    small = _block_min(plane, factor)
+    small_background = ndi.grey_opening(small, footprint=disk(max(1, int(round(radius / factor)))))
+    zoom = (plane.shape[0] / small.shape[0], plane.shape[1] / small.shape[1])
+    background = ndi.zoom(small_background.astype(np.float32), zoom, order=1)[:plane.shape[0], :plane.shape[1]]
+    background = np.minimum(background, plane)
+
+    return (plane - background).astype(plane.dtype, copy=False)
+
+
+def _correct_plane(pixels, zct, flatfield, background, tophat_radius, dtype):
+    z, c, t = zct
+    plane = pixels.getPlane(z, c, t)
+    if flatfield is not None:
+        plane = correct_planes(plane, flatfield[c], background, dtype)
+    if tophat_radius:
+        plane = white_tophat_fast(plane, tophat_radius)
+
+    return plane
+
+
+def _corrected_planes(image, flatfield, background, tophat_radius, dtype, workers, prefetch):
+    """Yields the corrected planes in the zct order of createImageFromNumpySeq, correcting up to
+    workers * prefetch planes in parallel"""
+    pixels = image.getPrimaryPixels()
+    zct_list = list(product(range(image.getSizeZ()), range(image.getSizeC()), range(image.getSizeT())))
+    window = workers * prefetch
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(zct_list), window):
+            yield from executor.map(lambda zct: _correct_plane(pixels, zct, flatfield, background,
+                                                               tophat_radius, dtype),
+                                    zct_list[start:start + window])
+
+
+def correct_image(connection, image, flatfield=None, background=0, tophat_radius=None, dataset=None,
+                  image_name=None, dtype=None, workers=4, prefetch=2):
+    """Creates a corrected copy of an image dividing every plane by the flat-field of its channel
+    ((c, y, x) array) after subtracting the background and/or removing the background with a top-hat
+    of tophat_radius. Planes are fetched and corrected by workers threads while they are uploaded.
+    Returns the new image"""
+    planes = _corrected_planes(image, flatfield, background, tophat_radius, dtype, workers, prefetch)
+
+    return connection.createImageFromNumpySeq(zctPlanes=planes,
+                                              imageName=image_name or f'{image.getName()}_corrected',
+                                              sizeZ=image.getSizeZ(),
+                                              sizeC=image.getSizeC(),
+                                              sizeT=image.getSizeT(),
+                                              description=f'Illumination corrected from Image:{image.getId()}',
+                                              dataset=dataset,
+                                              sourceImageId=image.getId())
+
+
+def correct_dataset(connection, dataset, target_dataset=None, method='mean', sigma=None, background=0,
+                    tophat_radius=None, dtype=None, workers=4, prefetch=2):
+    """Estimates the flat-field of every channel over all the images of a dataset and creates a corrected
+    copy of every image in target_dataset (by default the same dataset).
+    Returns the flat-fields and the ids of the new images"""
+    images = list(toolbox.get_dataset_images(dataset))
+    flatfield = estimate_flatfields(images, method=method, sigma=sigma)
+    new_image_ids = list()
+    for image in images:
+        new_image = correct_image(connection, image,
+                                  flatfield=flatfield,
+                                  background=background,
+                                  tophat_radius=tophat_radius,
+                                  dataset=target_dataset or dataset,
+                                  dtype=dtype,
+                                  workers=workers,
+                                  prefetch=prefetch)
+        new_image_ids.append(new_image.getId())
+
+    return flatfield, new_image_ids
@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+import numpy as np
+
+
+class PixelCache(object):
+    """A persistent local cache of pixel data chunks with least recently used eviction.
+
+    Every chunk is stored as a .npy file in directory and read back memory-mapped. Keys are tuples
+    identifying the chunk, eg: (image_id, pixels_update_event, z, c, t, (x, y, width, height)).
+    The access order is kept in the files modification times so that it survives across sessions.
+    When the cache grows beyond max_bytes the least recently used chunks are removed.
+    """
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size in bytes, least recently used first
+        self.size_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        files = [e for e in os.scandir(directory) if e.is_file() and e.name.endswith('.npy')]
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            self._entries[entry.name] = entry.stat().st_size
+            self.size_bytes += entry.stat().st_size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def _file_name(key):
+        return sha1(repr(key).encode()).hexdigest() + '.npy'
+
+    def __contains__(self, key):
+        return self._file_name(key) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, out=None):
+        """Returns the chunk stored under key or None if it is not cached.
+        If out is provided, the chunk is copied into it"""
+        file_name = self._file_name(key)
+        path = os.path.join(self.directory, file_name)
+        with self._lock:
+            if file_name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_name)
+        try:
+            chunk = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):  # The file was removed or is corrupted
+            with self._lock:
+                self._remove(file_name)
+                self.misses += 1
+            return None
+
+        if out is not None:
+            out[...] = chunk
+        else:
+            out = np.array(chunk)
+        with self._lock:
+            self.hits += 1
+            self.bytes_served += out.nbytes
+
+        return out
+
+    def put(self, key, chunk):
+        """Stores chunk under key, evicting the least recently used chunks if necessary"""
+        file_name = self._file_name(key)
+        path = os.path.join(self.directory, file_name)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(chunk))
+        os.replace(temp_path, path)  # So that readers never see a partially written file
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self.size_bytes += size - self._entries.pop(file_name, 0)
+            self._entries[file_name] = size
+            self.bytes_stored += size
+            self._evict()
+
+    def _remove(self, file_name):
+        self.size_bytes -= self._entries.pop(file_name, 0)
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.size_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for file_name in list(self._entries):
+                self._remove(file_name)
+
+    def stats(self):
+        """Returns the hit/miss counters and the bytes served from and stored into the cache"""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.0,
+                    'bytes_served': self.bytes_served,
+                    'bytes_stored': self.bytes_stored,
+                    'evictions': self.evictions,
+                    'size_bytes': self.size_bytes,
+                    'max_bytes': self.max_bytes,
+                    'entries': len(self._entries),
+                    }
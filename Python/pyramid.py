@@ -0,0 +1,144 @@
+"""Local multi-resolution copies of images, stored as OME-Zarr style multiscales (OME-NGFF 0.4, zarr v2
+uncompressed, one chunk per plane) so that they can be read by get_intensities at a lower resolution
+or opened with any zarr reader.
+eg:
+    store = PyramidStore('/data/pyramids')
+    store.write(image_id, data, levels=4)  # data is a zctyx array (planes as stored by OMERO), eg: a .npy memmap
+    toolbox.set_pyramid_store(store)
+    toolbox.get_intensities(image, c_range=0, level=2)  # reads 16 times fewer bytes
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+import numpy as np
+
+AXES = [{'name': 't', 'type': 'time'},
+        {'name': 'c', 'type': 'channel'},
+        {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+        {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+        {'name': 'x', 'type': 'space', 'unit': 'micrometer'}]
+
+
+def downsample_block_mean(planes, factor=2):
+    """Downsamples a plane or (..., y, x) stack of planes by the mean of factor x factor blocks.
+    Planes are padded with their edge values to a multiple of factor. Integer planes are rounded"""
+    planes = np.asarray(planes)
+    size_y, size_x = planes.shape[-2:]
+    pad = [(0, 0)] * (planes.ndim - 2) + [(0, -size_y % factor), (0, -size_x % factor)]
+    padded = np.pad(planes, pad, mode='edge') if size_y % factor or size_x % factor else planes
+    blocks = padded.reshape(padded.shape[:-2] + (padded.shape[-2] // factor, factor,
+                                                  padded.shape[-1] // factor, factor))
+    means = blocks.mean(axis=(-3, -1), dtype=np.float32)
+    if np.issubdtype(planes.dtype, np.integer):
+        np.rint(means, out=means)
+
+    return means.astype(planes.dtype, copy=False)
+
+
+def _level_shape(size_y, size_x, level, factor):
+    scale = factor ** level
+    return -(-size_y // scale), -(-size_x // scale)
+
+
+class PyramidStore(object):
+    """Stores the multiscales of images in directory, as <image_id>.zarr"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, image_id):
+        return os.path.join(self.directory, f'{image_id}.zarr')
+
+    def __contains__(self, image_id):
+        return os.path.exists(os.path.join(self.path(image_id), '.zattrs'))
+
+    def _write_plane(self, image_id, plane, t, c, z, levels, factor, convert):
+        if convert is not None:
+            plane = convert(plane)
+        for level in range(levels):
+            if level:
+                plane = downsample_block_mean(plane, factor)
+            chunk_directory = os.path.join(self.path(image_id), str(level), str(t), str(c), str(z), '0')
+            os.makedirs(chunk_directory, exist_ok=True)
+            np.ascontiguousarray(plane, dtype=plane.dtype.newbyteorder('<')).tofile(
+                os.path.join(chunk_directory, '0'))
+
+        return plane.dtype
+
+    def write(self, image_id, data, levels=4, factor=2, pixel_sizes=None, workers=4, convert=None, name=None):
+        """Writes the levels of a zctyx array, with (y, x) planes as OMERO stores them and not the zctxy order
+        of get_intensities, the first one being the full resolution.
+        Planes are downsampled one at a time, over workers threads, so data can be a memory map.
+        convert is an optional function applied to every plane before downsampling (eg: a dtype conversion)
+        pixel_sizes are the (x, y, z) pixel sizes at full resolution"""
+        size_z, size_c, size_t, size_y, size_x = data.shape
+        zct_list = list(product(range(size_z), range(size_c), range(size_t)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            dtypes = list(executor.map(lambda zct: self._write_plane(image_id, data[zct], zct[2], zct[1], zct[0],
+                                                                     levels, factor, convert),
+                                       zct_list))
+        dtype = dtypes[0] if dtypes else data.dtype
+
+        path = self.path(image_id)
+        physical_x, physical_y, physical_z = pixel_sizes or (1.0, 1.0, 1.0)
+        datasets = list()
+        for level in range(levels):
+            level_y, level_x = _level_shape(size_y, size_x, level, factor)
+            with open(os.path.join(path, str(level), '.zarray'), 'w') as f:
+                json.dump({'zarr_format': 2,
+                           'shape': [size_t, size_c, size_z, level_y, level_x],
+                           'chunks': [1, 1, 1, level_y, level_x],
+                           'dtype': np.dtype(dtype).newbyteorder('<').str,
+                           'compressor': None,
+                           'fill_value': 0,
+                           'order': 'C',
+                           'filters': None,
+                           'dimension_separator': '/'}, f)
+            scale = factor ** level
+            datasets.append({'path': str(level),
+                             'coordinateTransformations': [{'type': 'scale',
+                                                            'scale': [1.0, 1.0, physical_z,
+                                                                      physical_y * scale, physical_x * scale]}]})
+        with open(os.path.join(path, '.zgroup'), 'w') as f:
+            json.dump({'zarr_format': 2}, f)
+        with open(os.path.join(path, '.zattrs'), 'w') as f:  # Written last, marking the pyramid as complete
+            json.dump({'multiscales': [{'version': '0.4',
+                                        'name': name or str(image_id),
+                                        'axes': AXES,
+                                        'datasets': datasets,
+                                        'type': 'mean',
+                                        'metadata': {'factor': factor}}]}, f)
+
+    def _array_metadata(self, image_id, level):
+        with open(os.path.join(self.path(image_id), str(level), '.zarray')) as f:
+            return json.load(f)
+
+    def nr_levels(self, image_id):
+        with open(os.path.join(self.path(image_id), '.zattrs')) as f:
+            return len(json.load(f)['multiscales'][0]['datasets'])
+
+    def dtype(self, image_id, level):
+        return np.dtype(self._array_metadata(image_id, level)['dtype'])
+
+    def shape(self, image_id, level):
+        """Returns the shape of a level as (z, c, t, x, y), the order of toolbox.get_image_shape"""
+        size_t, size_c, size_z, size_y, size_x = self._array_metadata(image_id, level)['shape']
+        return size_z, size_c, size_t, size_x, size_y
+
+    def read(self, image_id, level, zct_list, x_range, y_range, out=None):
+        """Reads the x_range, y_range region (in the coordinates of the level) of the (z, c, t) planes
+        into a (planes, y, x) array. Only the region is read from every plane file"""
+        metadata = self._array_metadata(image_id, level)
+        dtype = np.dtype(metadata['dtype'])
+        size_y, size_x = metadata['shape'][3:]
+        if out is None:
+            out = np.empty((len(zct_list), len(y_range), len(x_range)), dtype=dtype)
+        for i, (z, c, t) in enumerate(zct_list):
+            plane = np.memmap(os.path.join(self.path(image_id), str(level), str(t), str(c), str(z), '0', '0'),
+                              dtype=dtype, mode='r', shape=(size_y, size_x))
+            out[i] = plane[y_range.start:y_range.stop:y_range.step, x_range.start:x_range.stop:x_range.step]
+            del plane
+
+        return out
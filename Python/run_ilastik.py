@@ -1,10 +1,21 @@
 # This script has been used to run ilastik locally and import the results to OMERO
 
 import os
+import time
+import logging
+import shutil
+import tempfile
+import threading
+from queue import Queue
 import numpy as np
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from omero.gateway import BlitzGateway
 from getpass import getpass
+from pyramid import PyramidStore
+
+logger = logging.getLogger(__name__)
 
 ILASTIK_PATH = '/home/julio/Apps/ilastik-1.3.2post1-Linux/run_ilastik.sh'
 DIRECTORY = '/run/media/julio/DATA/Quentin/training_dataset/numpy_arrays'
@@ -14,86 +25,331 @@ INPUT_SUBFIXES = ['DAPI.npy', 'DAPI_Ch1.npy', 'DAPI_Ch2.npy', 'DAPI_Ch3.npy']
 
 HOST = 'workshop.openmicroscopy.org'
 PORT = 4064
-USER = input('Username:')
-PW = getpass()
 DATASET_ID = 6206
 OUTPUT_SUBFIX = '_Probabilities.npy'
 
 
-def plane_gen(data):
+def _convert_plane(plane, dtype):
+    """Converts a plane to dtype. Floating point probabilities (0 to 1) are scaled to the range of integer types"""
+    if dtype is None or plane.dtype == dtype:
+        return plane
+    if np.issubdtype(plane.dtype, np.floating) and np.issubdtype(dtype, np.integer):
+        max_value = np.iinfo(dtype).max
+        converted = np.multiply(plane, max_value, dtype=np.float32)
+        np.clip(converted, 0, max_value, out=converted)
+        return np.rint(converted, out=converted).astype(dtype)
+    return plane.astype(dtype)
+
+
+def plane_gen(data, dtype=None):
     """
     Set up a generator of 2D numpy arrays.
 
     The createImage method below expects planes in the order specified here
     (for z.. for c.. for t..)
-
+    Planes are views of data, so a memory mapped array is read one plane at a time.
+    If dtype is provided every plane is converted to it when it is yielded.
     """
+    dtype = None if dtype is None else np.dtype(dtype)
     for z in range(data.shape[0]):  # all Z sections data.shape[0]
         for c in range(data.shape[1]):  # all channels
             for t in range(data.shape[2]):  # all time-points
-                yield data[z][c][t]
+                yield _convert_plane(data[z, c, t], dtype)
+
+
+def _output_path(input_path):
+    """The path ilastik writes the probabilities of an input to by default: {dataset_dir}/{nickname}_Probabilities.npy"""
+    return os.path.splitext(input_path)[0] + OUTPUT_SUBFIX
+
+
+def _is_up_to_date(input_path, model_path):
+    output_path = _output_path(input_path)
+    if not os.path.exists(output_path):
+        return False
+    return os.path.getmtime(output_path) >= max(os.path.getmtime(input_path), os.path.getmtime(model_path))
+
+
+def _run_ilastik_group(ilastik_path, model_path, inputs, threads, output_axis_order='zctxy', input_axes=None):
+    """Runs a single ilastik process over several inputs and returns the timing and errors of every input"""
+    cmd = [ilastik_path,
+           '--headless',
+           f'--project={model_path}',
+           '--export_source=Probabilities',
+           '--output_format=numpy',
+           f'--output_axis_order={output_axis_order}']
+    if input_axes:
+        cmd.append(f'--input_axes={input_axes}')
+    cmd.extend(inputs)
+    env = dict(os.environ, LAZYFLOW_THREADS=str(threads))
+    start = time.time()
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    end = time.time()
+    stderr = process.stderr.decode(errors='replace')
+    if process.returncode:
+        logger.error(f'ilastik failed with return code {process.returncode}. Input command: {cmd}\nError: {stderr}')
+
+    # ilastik processes the inputs one after the other, so the time an output was written tells
+    # when the processing of every input finished
+    results = list()
+    previous_end = start
+    for input_path in inputs:
+        output_path = _output_path(input_path)
+        if os.path.exists(output_path) and os.path.getmtime(output_path) >= start:
+            input_end = os.path.getmtime(output_path)
+            succeeded = True
+        else:
+            input_end = end
+            succeeded = False
+        results.append({'input': input_path,
+                        'model': model_path,
+                        'output': output_path,
+                        'succeeded': succeeded,
+                        'returncode': process.returncode,
+                        'stderr': stderr,
+                        'seconds': max(0., input_end - previous_end)})
+        previous_end = max(previous_end, input_end)
+
+    return results
+
+
+def run_ilastik_batch(ilastik_path, directory, models, subfixes, workers=2, threads=None,
+                      files_per_invocation=None, force=False):
+    """Runs ilastik over all the inputs in directory, grouping the inputs of every model into
+    as few ilastik invocations as possible so that ilastik starts and loads every project only once.
+    - workers: the number of ilastik processes running at the same time
+    - threads: the number of threads of every ilastik process. By default the cpus are split among the workers
+    - files_per_invocation: the maximum number of inputs per ilastik process. By default, the inputs of a model
+      are split among the workers when there are fewer models than workers
+    - force: inputs whose probabilities output is newer than both the input and the model are skipped unless force
+    Returns a list with, for every input processed, a dictionary with the input, model, output, succeeded,
+    returncode, stderr and seconds it took.
+    """
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    files = sorted(os.listdir(directory))
+
+    groups = list()
+    for model, subfix in zip(models, subfixes):
+        model_path = os.path.join(directory, model)
+        inputs = [os.path.join(directory, f) for f in files if subfix in f]
+        if not force:
+            inputs = [i for i in inputs if not _is_up_to_date(i, model_path)]
+        if not inputs:
+            continue
+        group_size = files_per_invocation or max(1, -(-len(inputs) * len(models) // workers))
+        for start in range(0, len(inputs), group_size):
+            groups.append((model_path, inputs[start:start + group_size]))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_ilastik_group, ilastik_path, model_path, inputs, threads)
+                   for model_path, inputs in groups]
+        results = [result for future in futures for result in future.result()]
+
+    return results
 
 
 def run_ilastik(ilastik_path, directory, models, subfixes):
-    files = os.listdir(directory)
-    
-    for m in range(len(models)):
-        inputs = []
-        for f in files:
-            if subfixes[m] in f:
-                inputs.append(os.path.join(directory, f))
-        
-        for i in inputs:
-            cmd = [ilastik_path,
-                   '--headless',
-                   f'--project={os.path.join(directory, models[m])}',
-                   '--export_source=Probabilities',
-                   '--output_format=numpy',
-                   # f'--output_filename_format={{dataset_dir}}/{{nickname}}_Probabilities.npy',
-                   '--output_axis_order=zctxy',
-                   i]
+    """Runs ilastik over all the inputs in directory, one input per ilastik process. See run_ilastik_batch"""
+    return run_ilastik_batch(ilastik_path, directory, models, subfixes, workers=1, files_per_invocation=1,
+                             force=True)
+
+
+def _download_image(image, path):
+    """Writes the planes of an image into a tzyxc .npy file as they are received, without intermediate copies"""
+    pixels = image.getPrimaryPixels()
+    size_z, size_c, size_t = image.getSizeZ(), image.getSizeC(), image.getSizeT()
+    data = np.lib.format.open_memmap(path, mode='w+',
+                                     dtype=pixels.getPlane(0, 0, 0).dtype,
+                                     shape=(size_t, size_z, image.getSizeY(), image.getSizeX(), size_c))
+    zct_list = [(z, c, t) for t in range(size_t) for z in range(size_z) for c in range(size_c)]
+    for (z, c, t), plane in zip(zct_list, pixels.getPlanes(zct_list)):
+        data[t, z, :, :, c] = plane
+    data.flush()
+    del data
+
+
+def _scratch_directory():
+    """A directory in memory (shared memory) when available, so the pipeline does not write to disk"""
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def run_ilastik_pipeline(conn, images, ilastik_path, model_path, dataset, workers=1, threads=None,
+                         queue_size=2, scratch_dir=None, upload_conn=None):
+    """Runs ilastik over OMERO images and uploads the probabilities as new images into dataset.
+    Download, inference and upload run in separate threads connected by queues of at most queue_size
+    images, so they overlap and at most a few images are held at the same time.
+    Images are exchanged with ilastik as .npy files in scratch_dir, by default the shared memory (/dev/shm)
+    so nothing is written to disk. Probabilities are uploaded plane by plane from a memory mapped file.
+    An image failing at any stage does not stop the others.
+    Returns the ids of the new images in the order of images (None when an image failed) and a dictionary
+    with the exception of every image that failed, by image id.
+    """
+    images = list(images)
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    upload_conn = upload_conn or conn
+    work_dir = tempfile.mkdtemp(prefix='ilastik_pipeline_', dir=scratch_dir or _scratch_directory())
+    download_queue = Queue(maxsize=queue_size)
+    upload_queue = Queue(maxsize=queue_size)
+    new_image_ids = [None] * len(images)
+    errors = dict()
+
+    def download():
+        try:
+            for index, image in enumerate(images):
+                input_path = os.path.join(work_dir, f'{index}_{image.getId()}.npy')
+                try:
+                    _download_image(image, input_path)
+                except Exception as e:
+                    errors[image.getId()] = e
+                    if os.path.exists(input_path):
+                        os.remove(input_path)
+                    continue
+                download_queue.put((index, image, input_path))
+        finally:
+            for _ in range(workers):
+                download_queue.put(None)
+
+    def inference():
+        while True:
+            item = download_queue.get()
+            if item is None:
+                upload_queue.put(None)
+                return
+            index, image, input_path = item
             try:
-                subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout
-            except subprocess.CalledProcessError as e:
-                print(f'Input command: {cmd}')
-                print()
-                print(f'Error: {e.output}')
-                print()
-                print(f'Command: {e.cmd}')
-                print()
+                result = _run_ilastik_group(ilastik_path, model_path, [input_path], threads,
+                                            output_axis_order='zctyx', input_axes='tzyxc')[0]
+            except Exception as e:
+                errors[image.getId()] = e
+                continue
+            finally:
+                os.remove(input_path)
+            if result['succeeded']:
+                upload_queue.put((index, image, result['output']))
+            else:
+                errors[image.getId()] = Exception(f'ilastik failed on image {image.getId()}: {result["stderr"]}')
+
+    def upload():
+        finished_workers = 0
+        while finished_workers < workers:
+            item = upload_queue.get()
+            if item is None:
+                finished_workers += 1
+                continue
+            index, image, output_path = item
+            try:
+                data = np.load(output_path, mmap_mode='r')
+                new_image = upload_conn.createImageFromNumpySeq(zctPlanes=plane_gen(data),
+                                                                imageName=f'{image.getName()}_Probabilities',
+                                                                sizeZ=data.shape[0],
+                                                                sizeC=data.shape[1],
+                                                                sizeT=data.shape[2],
+                                                                description=f'ilastik probabilities from Image:{image.getId()}',
+                                                                dataset=dataset)
+                new_image_ids[index] = new_image.getId()
+                del data
+            except Exception as e:
+                errors[image.getId()] = e
+            finally:
+                os.remove(output_path)
+
+    stages = [threading.Thread(target=download), threading.Thread(target=upload)]
+    stages += [threading.Thread(target=inference) for _ in range(workers)]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return new_image_ids, errors
+
+
+def _import_np_array(conn, path, dataset, dtype=None, pyramid_store=None, pyramid_levels=4, pyramid_workers=4):
+    """Imports a .npy file as an Image, reading it plane by plane from a memory map.
+    The array is zctyx: every data[z, c, t] plane is uploaded as a (y, x) plane, as OMERO stores them.
+    The outputs of run_ilastik are zctxy, the order of get_intensities, so their planes are uploaded transposed.
+    If a pyramid_store is provided, a multi-resolution copy of the image is also written into it"""
+    omero_name = os.path.basename(path)
+    data = np.load(path, mmap_mode='r')
+    uploaded_bytes = [0]
 
+    def counted_planes():
+        for plane in plane_gen(data, dtype=dtype):
+            uploaded_bytes[0] += plane.nbytes
+            yield plane
 
-def import_np_arrays(host, port, user, pw, dataset_id, directory, subfix):
+    start = time.time()
+    desc = f'ilastik probabilities'
+    new_image = conn.createImageFromNumpySeq(zctPlanes=counted_planes(),
+                                             imageName=omero_name,
+                                             sizeZ=data.shape[0],
+                                             sizeC=data.shape[1],
+                                             sizeT=data.shape[2],
+                                             description=desc,
+                                             dataset=dataset)
+    seconds = time.time() - start
+    print(f'Saved {omero_name} as Image {new_image.getId()}: '
+          f'{uploaded_bytes[0] / 2 ** 20 / max(seconds, 1e-9):.1f} MB/s')
+
+    if pyramid_store is not None:
+        pyramid_store.write(new_image.getId(), data,
+                            levels=pyramid_levels,
+                            workers=pyramid_workers,
+                            convert=partial(_convert_plane, dtype=None if dtype is None else np.dtype(dtype)),
+                            name=omero_name)
+
+    return new_image.getId()
+
+
+def import_np_arrays(host, port, user, pw, dataset_id, directory, subfix, workers=1, dtype=None,
+                     pyramid_directory=None, pyramid_levels=4, pyramid_workers=4):
+    """Imports every .npy file in directory with subfix in its name as an Image into the dataset.
+    Files are read memory mapped, one plane at a time, and converted to dtype (eg: 'uint8') if provided.
+    workers files are uploaded at the same time, each one on its own connection joining the session of the first.
+    If a pyramid_directory is provided, pyramid_levels resolution levels of every image are stored in it
+    (see pyramid.PyramidStore), to be read with toolbox.get_intensities(image, level=...)
+    Returns a dictionary with the new image id of every file.
+    """
     conn = BlitzGateway(user, pw, host=host, port=port)
     conn.connect()
     dataset = conn.getObject('Dataset', dataset_id)
-    print(f'Destination dataset is: {dataset.getname()}')
-
-    files = os.listdir(directory)
-
-    for file in files:
-        if subfix in file:
-            # Save the probabilities file
-            omero_name = file
-            print(f'Saving Probabilities as an Image in OMERO as {omero_name}')
-            output_data = np.load(os.path.join(directory, file))
-            # print(f'old shape = {output_data.shape}')
-            # if len(output_data.shape) == 4:
-            #     output_data = output_data.reshape(output_data.shape[:2] + (1,) + output_data.shape[2:])
-            # print(f'new shape = {output_data.shape}')
-            desc = f'ilastik probabilities'
-            conn.createImageFromNumpySeq(zctPlanes=plane_gen(output_data),
-                                         imageName=omero_name,
-                                         sizeZ=output_data.shape[0],
-                                         sizeC=output_data.shape[1],
-                                         sizeT=output_data.shape[2],
-                                         description=desc,
-                                         dataset=dataset)
+    print(f'Destination dataset is: {dataset.getName()}')
+
+    files = sorted(file for file in os.listdir(directory) if subfix in file)
+    pyramid_store = PyramidStore(pyramid_directory) if pyramid_directory else None
+    session_key = conn.getSession().getUuid().getValue()
+    local = threading.local()
+    connections = list()
 
+    def get_connection():
+        if not hasattr(local, 'conn'):
+            local.conn = BlitzGateway(host=host, port=port)
+            local.conn.connect(sUuid=session_key)
+            connections.append(local.conn)
+        return local.conn
+
+    def import_file(file):
+        print(f'Saving Probabilities as an Image in OMERO as {file}')
+        return _import_np_array(get_connection(), os.path.join(directory, file), dataset, dtype=dtype,
+                                pyramid_store=pyramid_store,
+                                pyramid_levels=pyramid_levels,
+                                pyramid_workers=pyramid_workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        image_ids = dict(zip(files, executor.map(import_file, files)))
+
+    for worker_conn in connections:
+        worker_conn.close(hard=False)
     conn.close()
 
+    return image_ids
+
 
 if __name__ == '__main__':
+    USER = input('Username:')
+    PW = getpass()
+
     run_ilastik(ilastik_path=ILASTIK_PATH,
                 directory=DIRECTORY2,
                 models=MODELS,
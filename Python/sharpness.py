@@ -0,0 +1,162 @@
+"""Sharpness metrics of CalculateSharpnessOneImage.ipynb computed over stacks of planes, used to find the
+best focused planes and to detect autofocus failures over whole datasets."""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.ndimage import convolve
+from skimage import feature
+import toolbox
+
+
+def gradient_sharpness(planes):
+    """The average norm of the gradient of every plane of a (n, y, x) stack"""
+    planes = np.asarray(planes, dtype=np.float32)
+    gy, gx = np.gradient(planes, axis=(1, 2))
+    gnorm = np.sqrt(gx ** 2 + gy ** 2, out=gx)
+
+    return gnorm.mean(axis=(1, 2), dtype=np.float64)
+
+
+def fourier_sharpness(planes):
+    """The number of frequencies of every plane of a (n, y, x) stack with a magnitude over 1/1000 of the maximum.
+    The spectrum of a real plane is symmetric so only half of it is computed (rfft2) and the frequencies
+    that have a symmetric counterpart are counted twice, giving the same count as the full spectrum."""
+    planes = np.asarray(planes, dtype=np.float32)
+    size_x = planes.shape[2]
+    magnitudes = np.abs(np.fft.rfft2(planes, axes=(1, 2)))
+    thresholds = np.floor(magnitudes.max(axis=(1, 2)) / 1000)
+
+    weights = np.full(magnitudes.shape[2], 2, dtype=np.int64)
+    weights[0] = 1
+    if size_x % 2 == 0:
+        weights[-1] = 1
+    over_threshold = (magnitudes > thresholds[:, np.newaxis, np.newaxis]).sum(axis=1)
+
+    return over_threshold @ weights
+
+
+def edge_sharpness(planes, sigma=3):
+    """The number of edge pixels (Canny) with at least one neighbouring edge pixel of every plane of a (n, y, x) stack.
+    As in the notebook, where the convolution of the boolean edges is boolean too"""
+    planes = np.asarray(planes, dtype=np.float32)
+    edges = np.stack([feature.canny(plane, sigma=sigma) for plane in planes])
+    kernel = np.ones((1, 3, 3), dtype=np.uint8)
+    kernel[0, 1, 1] = 0
+    neighbours = convolve(edges.astype(np.uint8), kernel, mode='constant')
+
+    return ((neighbours > 0) & edges).sum(axis=(1, 2))
+
+
+SHARPNESS_METRICS = {'gradient': gradient_sharpness,
+                     'fourier': fourier_sharpness,
+                     'edge': edge_sharpness,
+                     }
+
+
+def compute_sharpness(planes, metrics=('gradient', 'fourier', 'edge'), batch_size=16):
+    """Computes the sharpness metrics over a (n, y, x) stack of planes in batches of batch_size planes.
+    Returns a dictionary with the array of scores of every metric"""
+    planes = np.asarray(planes)
+    scores = {metric: np.zeros(len(planes), dtype=np.float64) for metric in metrics}
+    for start in range(0, len(planes), batch_size):
+        batch = planes[start:start + batch_size].astype(np.float32, copy=False)
+        for metric in metrics:
+            scores[metric][start:start + batch_size] = SHARPNESS_METRICS[metric](batch)
+
+    return scores
+
+
+def _scores_dtype(metrics):
+    return np.dtype([('image_id', np.int64), ('z', np.int64), ('c', np.int64), ('t', np.int64)] +
+                    [(metric, np.float64) for metric in metrics] +
+                    [('best_focus', np.bool_)])
+
+
+def rank_focus(scores, metric='gradient'):
+    """Flags, for every image, channel and time point, the z plane with the highest score as best focus.
+    scores is a structured array as returned by get_image_sharpness. Modifies and returns scores"""
+    order = np.lexsort((-scores[metric], scores['t'], scores['c'], scores['image_id']))
+    ordered = scores[order]
+    first = np.ones(len(ordered), dtype=bool)
+    first[1:] = ((ordered['image_id'][1:] != ordered['image_id'][:-1]) |
+                 (ordered['c'][1:] != ordered['c'][:-1]) |
+                 (ordered['t'][1:] != ordered['t'][:-1]))
+    scores['best_focus'] = False
+    scores['best_focus'][order[first]] = True
+
+    return scores
+
+
+def get_image_sharpness(image, metrics=('gradient', 'fourier', 'edge'), batch_size=16, focus_metric=None):
+    """Scores every plane of an image, fetching and scoring batch_size planes at a time.
+    Returns a structured array with the image_id, z, c, t, the score of every metric and the best_focus flag
+    computed with focus_metric (by default the first metric)"""
+    pixels = image.getPrimaryPixels()
+    zct_list = [(z, c, t)
+                for t in range(image.getSizeT())
+                for c in range(image.getSizeC())
+                for z in range(image.getSizeZ())]
+    scores = np.zeros(len(zct_list), dtype=_scores_dtype(metrics))
+    scores['image_id'] = image.getId()
+    scores['z'], scores['c'], scores['t'] = np.array(zct_list).T
+
+    batch = np.empty((batch_size, image.getSizeY(), image.getSizeX()), dtype=np.float32)
+    for start in range(0, len(zct_list), batch_size):
+        zct_batch = zct_list[start:start + batch_size]
+        for i, plane in enumerate(pixels.getPlanes(zct_batch)):
+            batch[i] = plane
+        for metric in metrics:
+            scores[metric][start:start + len(zct_batch)] = SHARPNESS_METRICS[metric](batch[:len(zct_batch)])
+
+    return rank_focus(scores, metric=focus_metric or metrics[0])
+
+
+def get_dataset_sharpness(dataset, metrics=('gradient', 'fourier', 'edge'), batch_size=16, focus_metric=None,
+                          workers=4):
+    """Scores every plane of every image in a dataset, workers images at a time.
+    Returns a single structured array as get_image_sharpness"""
+    images = list(toolbox.get_dataset_images(dataset))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scores = list(executor.map(lambda image: get_image_sharpness(image,
+                                                                     metrics=metrics,
+                                                                     batch_size=batch_size,
+                                                                     focus_metric=focus_metric),
+                                   images))
+    if not scores:
+        return np.zeros(0, dtype=_scores_dtype(metrics))
+
+    return np.concatenate(scores)
+
+
+def save_sharpness_table(connection, scores, table_name, target=None, chunk_size=10000):
+    """Saves the scores in a single table annotation, linked to target (eg: the dataset) if provided"""
+    column_names = list(scores.dtype.names)
+    column_descriptions = ['Image', 'z plane', 'Channel', 'Time point'] + \
+                          [f'{name} sharpness' for name in column_names[4:-1]] + \
+                          ['Best focused z plane']
+    schema = ['image', 'long', 'long', 'long'] + ['double' for _ in column_names[4:-1]] + ['bool']
+    table = toolbox.create_annotation_table_streaming(connection=connection,
+                                                      table_name=table_name,
+                                                      column_names=column_names,
+                                                      column_descriptions=column_descriptions,
+                                                      batches=scores,
+                                                      schema=schema,
+                                                      chunk_size=chunk_size)
+    if target is not None:
+        toolbox.link_annotation(target, table)
+
+    return table
+
+
+def run_dataset_sharpness(connection, dataset, table_name='sharpness', metrics=('gradient', 'fourier', 'edge'),
+                          batch_size=16, focus_metric=None, workers=4):
+    """Scores every plane of a dataset and saves the scores as a table linked to the dataset.
+    Returns the scores and the table annotation"""
+    scores = get_dataset_sharpness(dataset,
+                                   metrics=metrics,
+                                   batch_size=batch_size,
+                                   focus_metric=focus_metric,
+                                   workers=workers)
+    table = save_sharpness_table(connection, scores, table_name, target=dataset)
+
+    return scores, table
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+import numpy as np
+import pytest
+from async_toolbox import AsyncConnection
+from fake_gateway import FakeConnection
+
+
+def test_calls_in_flight_are_bounded():
+    latency = .05
+    conn = FakeConnection(latency=latency)
+    image_ids = [conn.new_image(np.zeros((1, 1, 1, 4, 4), dtype=np.uint8)).getId() for _ in range(12)]
+    in_flight = list()
+    max_in_flight = list()
+    lock = threading.Lock()
+
+    def get_object(connection, obj_type, oid):
+        with lock:
+            in_flight.append(oid)
+            max_in_flight.append(len(in_flight))
+        try:
+            return connection.getObject(obj_type, oid)
+        finally:
+            with lock:
+                in_flight.remove(oid)
+
+    async def main():
+        async with AsyncConnection(conn, max_concurrency=3) as aconn:
+            return await aconn.gather(*[aconn.run_with_connection(get_object, 'Image', i) for i in image_ids])
+
+    start = time.perf_counter()
+    images = asyncio.run(main())
+    elapsed = time.perf_counter() - start
+
+    assert max(max_in_flight) == 3
+    assert conn.server.calls == 12
+    assert 4 * latency <= elapsed < 8 * latency  # 12 calls, 3 at a time
+    assert [image.getId() for image in images] == image_ids
+
+
+def test_results_are_returned_in_order():
+    conn = FakeConnection(latency=.01)
+    images = [conn.new_image(np.full((1, 1, 1, 4, 4), i, dtype=np.uint8)) for i in range(5)]
+
+    async def main():
+        async with AsyncConnection(conn, max_concurrency=2) as aconn:
+            found = await aconn.gather(*[aconn.get_image(image.getId()) for image in images])
+            intensities = await aconn.map(aconn.get_intensities, found)
+            return found, intensities
+
+    found, intensities = asyncio.run(main())
+
+    assert found == images
+    assert [int(i.max()) for i in intensities] == list(range(5))
+
+
+def test_exceptions_reach_the_caller():
+    conn = FakeConnection(latency=.01)
+    image = conn.new_image(np.zeros((1, 1, 1, 4, 4), dtype=np.uint8))
+
+    def fail(connection, message):
+        connection.getObject('Image', image.getId())
+        raise ValueError(message)
+
+    async def main():
+        async with AsyncConnection(conn, max_concurrency=2) as aconn:
+            with pytest.raises(ValueError, match='first'):
+                await aconn.run_with_connection(fail, 'first')
+            with pytest.raises(ValueError, match='second'):
+                await aconn.gather(aconn.get_image(image.getId()), aconn.run_with_connection(fail, 'second'))
+            # The slots of the failed calls are released
+            return await aconn.gather(*[aconn.get_image(image.getId()) for _ in range(4)])
+
+    assert asyncio.run(main()) == [image] * 4
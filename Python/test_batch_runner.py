@@ -0,0 +1,41 @@
+import json
+import batch_runner
+
+
+def _jobs():
+    return [((image_id, channel), image_id * 10 + channel) for image_id in range(3) for channel in range(2)]
+
+
+def test_interrupted_batch_is_resumed(tmp_path):
+    state_path = tmp_path / 'state.jsonl'
+    # Two jobs completed and the run interrupted while saving the third one
+    state_path.write_text(json.dumps((0, 0)) + '\n' + json.dumps((0, 1)) + '\n[1, ')
+    results = dict()
+
+    completed, failed = batch_runner.run_batch(_jobs(), fetch=lambda job: -job, analyze=abs,
+                                               sink=results.__setitem__, workers=2, state_path=str(state_path))
+
+    assert failed == {}
+    assert sorted(completed) == [(1, 0), (1, 1), (2, 0), (2, 1)]
+    assert results == {(1, 0): 10, (1, 1): 11, (2, 0): 20, (2, 1): 21}
+    assert batch_runner._load_state(str(state_path)) == {job_id for job_id, _ in _jobs()}
+
+    # Nothing is left to run
+    completed, _ = batch_runner.run_batch(_jobs(), fetch=lambda job: -job, analyze=abs,
+                                          sink=results.__setitem__, workers=2, state_path=str(state_path))
+    assert completed == []
+
+
+def test_failed_jobs_are_not_saved(tmp_path):
+    state_path = str(tmp_path / 'state.jsonl')
+
+    def sink(job_id, result):
+        if job_id == (2, 1):
+            raise ValueError('Could not save')
+
+    completed, failed = batch_runner.run_batch(_jobs(), fetch=lambda job: job, analyze=abs, sink=sink,
+                                               workers=2, state_path=state_path)
+
+    assert list(failed) == [(2, 1)]
+    assert len(completed) == 5
+    assert (2, 1) not in batch_runner._load_state(state_path)
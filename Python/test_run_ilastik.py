@@ -0,0 +1,106 @@
+import os
+import sys
+import numpy as np
+import pytest
+import run_ilastik
+
+FAKE_ILASTIK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_run_ilastik.sh')
+
+
+@pytest.fixture
+def ilastik_log(tmp_path, monkeypatch):
+    """The arguments of every invocation of the fake ilastik"""
+    log_path = tmp_path / 'ilastik.log'
+    monkeypatch.setenv('FAKE_ILASTIK_LOG', str(log_path))
+    monkeypatch.setenv('PYTHON', sys.executable)
+
+    def invocations():
+        if not log_path.exists():
+            return list()
+        return [[a for a in line.split() if not a.startswith('--')] for line in log_path.read_text().splitlines()]
+
+    return invocations
+
+
+def _make_inputs(directory, models, names):
+    directory.mkdir()
+    for model in models:
+        (directory / model).write_bytes(b'')
+    for name in names:
+        np.save(directory / name, np.full((2, 1, 1, 4, 5), 51, dtype=np.uint8))
+    return str(directory)
+
+
+def test_inputs_of_a_model_run_in_one_invocation(tmp_path, ilastik_log):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp', 'b.ilp'],
+                             [f'im{i}_DAPI.npy' for i in range(3)] + [f'im{i}_Ch1.npy' for i in range(3)])
+
+    results = run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp', 'b.ilp'], ['DAPI.npy', 'Ch1.npy'],
+                                            workers=2)
+
+    assert sorted(len(inputs) for inputs in ilastik_log()) == [3, 3]
+    assert len(results) == 6
+    assert all(result['succeeded'] and result['returncode'] == 0 for result in results)
+    for result in results:
+        assert np.allclose(np.load(result['output']), .2)
+
+
+def test_inputs_are_split_among_workers(tmp_path, ilastik_log):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp'], [f'im{i}_DAPI.npy' for i in range(4)])
+
+    run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=2)
+
+    assert sorted(len(inputs) for inputs in ilastik_log()) == [2, 2]
+
+
+def test_files_per_invocation(tmp_path, ilastik_log):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp'], [f'im{i}_DAPI.npy' for i in range(4)])
+
+    run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=2, files_per_invocation=1)
+
+    assert [len(inputs) for inputs in ilastik_log()] == [1, 1, 1, 1]
+
+
+def test_up_to_date_outputs_are_skipped(tmp_path, ilastik_log):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp'], [f'im{i}_DAPI.npy' for i in range(3)])
+    run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=1)
+    assert len(ilastik_log()) == 1
+
+    assert run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=1) == []
+    assert len(ilastik_log()) == 1
+
+    # An input newer than its output is processed again
+    updated = os.path.join(directory, 'im1_DAPI.npy')
+    newer = os.path.getmtime(updated) + 10
+    os.utime(updated, (newer, newer))
+    results = run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=1)
+    assert [result['input'] for result in results] == [updated]
+
+    results = run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=1,
+                                            force=True)
+    assert len(results) == 3
+
+
+def test_results_of_every_input(tmp_path, ilastik_log, caplog):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp'], ['im0_DAPI.npy', 'im1_fail_DAPI.npy', 'im2_DAPI.npy'])
+
+    with caplog.at_level('ERROR', logger='run_ilastik'):
+        results = run_ilastik.run_ilastik_batch(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'], workers=1)
+
+    assert len(ilastik_log()) == 1
+    by_input = {os.path.basename(result['input']): result for result in results}
+    assert by_input['im0_DAPI.npy']['succeeded'] and by_input['im2_DAPI.npy']['succeeded']
+    failed = by_input['im1_fail_DAPI.npy']
+    assert not failed['succeeded']
+    assert failed['returncode'] == 1
+    assert 'Could not process' in failed['stderr']
+    assert all(result['seconds'] >= 0 for result in results)
+    assert 'Could not process' in caplog.text
+
+
+def test_run_ilastik_runs_every_input_separately(tmp_path, ilastik_log):
+    directory = _make_inputs(tmp_path / 'data', ['a.ilp'], [f'im{i}_DAPI.npy' for i in range(3)])
+    run_ilastik.run_ilastik(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'])
+    run_ilastik.run_ilastik(FAKE_ILASTIK, directory, ['a.ilp'], ['DAPI.npy'])
+
+    assert [len(inputs) for inputs in ilastik_log()] == [1] * 6
@@ -0,0 +1,341 @@
+import threading
+import time
+import numpy as np
+import pytest
+import toolbox
+from fake_gateway import FakeConnection, FakeSessions, synthetic_spots
+
+
+def _pool(sessions, max_connections=4):
+    return toolbox.ConnectionPool('user', 'password', None, 4064, 'host', max_connections=max_connections,
+                                  keepalive_interval=0, gateway_class=sessions.gateway_class())
+
+
+########## ConnectionPool ##########
+
+def test_pool_logs_in_once_and_bounds_the_connections():
+    sessions = FakeSessions()
+    pool = _pool(sessions, max_connections=3)
+    in_use = list()
+    max_in_use = list()
+    lock = threading.Lock()
+
+    def work():
+        for _ in range(5):
+            with pool.connection() as conn:
+                assert conn.isConnected()
+                with lock:
+                    in_use.append(conn)
+                    max_in_use.append(len(in_use))
+                time.sleep(.005)
+                with lock:
+                    in_use.remove(conn)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+
+    assert sessions.logins == 1
+    assert sessions.joins <= 2
+    assert max(max_in_use) <= 3
+
+
+def test_pool_connects_concurrently():
+    latency = .1
+    sessions = FakeSessions(latency=latency)
+    pool = _pool(sessions, max_connections=4)
+    pool.release(pool.acquire())  # Logs in
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=lambda: pool.release(pool.acquire())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    pool.close()
+
+    # One ping of the idle connection and three joins, at the same time and not one after the other
+    assert sessions.joins == 3
+    assert elapsed < 3 * latency
+
+
+def test_pool_replaces_broken_connections():
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    conn = pool.acquire()
+    conn.close(hard=False)
+    pool.release(conn)
+
+    with pool.connection() as conn:
+        assert conn.isConnected()
+    assert sessions.logins == 1
+    assert sessions.joins == 1
+
+
+def test_pool_pings_once_per_acquire_and_release():
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    pool.release(pool.acquire())  # Logs in
+    calls = sessions.server.calls
+
+    for cycle in range(1, 4):
+        pool.release(pool.acquire())
+        assert sessions.server.calls == calls + cycle  # The ping of the idle connection by acquire
+    pool.close()
+
+
+def test_pool_logs_in_again_when_the_session_expires():
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    with pool.connection() as conn:
+        session_key = conn.session_key
+    sessions.kill(session_key)
+
+    with pool.connection() as conn:
+        assert conn.isConnected()
+        assert conn.session_key != session_key
+    assert sessions.logins == 2
+
+
+def test_pool_close_waits_for_the_connections_in_use():
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    idle = pool.acquire()
+    in_use = pool.acquire()
+    pool.release(idle)
+
+    pool.close()
+    assert in_use.isConnected()  # The session is still open
+
+    pool.release(in_use)
+    assert sessions.active == set()
+
+
+def test_pool_close_closes_the_session():
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    pool.release(pool.acquire())
+    pool.close()
+    assert sessions.active == set()
+
+    sessions = FakeSessions()
+    pool = _pool(sessions)
+    conn = pool.acquire()
+    conn.close(hard=False)
+    pool.release(conn)  # The broken connection is idle
+    pool.close()
+    assert sessions.active == set()
+
+
+########## get_intensities ##########
+
+@pytest.fixture
+def image():
+    """A non square image, with its pixels in a zctyx array"""
+    conn = FakeConnection()
+    data = np.arange(2 * 3 * 2 * 30 * 50, dtype=np.uint16).reshape((2, 3, 2, 30, 50))
+    return conn.new_image(data)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'workers': 3}, {'workers': 3, 'planes_per_chunk': 1}, {'tile_size': (16, 8)}])
+def test_get_intensities_returns_zctxy(image, kwargs):
+    expected = image.data.transpose((0, 1, 2, 4, 3))
+
+    assert np.array_equal(toolbox.get_intensities(image, **kwargs), expected)
+    region = toolbox.get_intensities(image, z_range=1, c_range=(0, 3, 2), x_range=(5, 45), y_range=(3, 20), **kwargs)
+    assert np.array_equal(region, expected[1:2, 0:3:2, :, 5:45, 3:20])
+
+
+def test_get_intensities_fetches_aligned_tiles(image):
+    server = image.server
+    toolbox.get_intensities(image, c_range=0, x_range=(10, 40), y_range=(5, 20), tile_size=(16, 16), workers=2)
+
+    # x is split at 16 and 32 and y at 16, for the 4 planes
+    assert server.calls == 4 * 3 * 2
+    assert server.bytes == 4 * 30 * 15 * 2
+
+
+def test_get_intensities_fetches_chunks_concurrently():
+    latency = .02
+    conn = FakeConnection(latency=latency)
+    image = conn.new_image(np.zeros((8, 1, 1, 16, 16), dtype=np.uint8))
+
+    start = time.perf_counter()
+    toolbox.get_intensities(image, workers=4, planes_per_chunk=1)
+    elapsed = time.perf_counter() - start
+
+    assert conn.server.calls == 8
+    assert elapsed < 8 * latency / 2
+
+
+########## segment_channel ##########
+
+def _same_partition(labels, other):
+    """Whether both label images have the same background and objects, whatever their label values"""
+    if not np.array_equal(labels > 0, other > 0):
+        return False
+    pairs = np.unique(np.stack((labels.ravel(), other.ravel())), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+@pytest.mark.parametrize('method, sigma, hysteresis_levels', [('hysteresis', None, (.3, .6)),
+                                                              ('hysteresis', 1.0, (.2, .4)),
+                                                              ('local_max', None, (.5, 1.5)),
+                                                              ('local_max', 1.0, (.5, 1.5))])
+@pytest.mark.parametrize('block_shape', [(8, 32, 32), (5, 17, 23)])
+def test_blocked_segmentation_matches_the_whole_channel(method, sigma, hysteresis_levels, block_shape):
+    channel, _ = synthetic_spots(shape=(16, 64, 64), nr_spots=40)
+
+    labels = toolbox.segment_channel(channel, 2, sigma, method, hysteresis_levels)
+    blocked = toolbox.segment_channel(channel, 2, sigma, method, hysteresis_levels, block_shape=block_shape, workers=2)
+
+    assert labels.max() > 1
+    assert blocked.max() == labels.max()
+    assert _same_partition(labels, blocked)
+
+
+########## Spots measurements ##########
+
+def test_spots_properties_match_regionprops():
+    from skimage.measure import label, regionprops
+    rng = np.random.default_rng(0)
+    channel = rng.uniform(0, 100, (6, 20, 12)).astype(np.float32)  # (z, x, y)
+    labels = label(rng.uniform(size=channel.shape) > .9)
+    pixel_size = (.1, .2, .5)  # (x, y, z)
+
+    properties = toolbox.compute_channel_spots_properties(channel, labels, pixel_size=pixel_size)
+
+    regions = regionprops(labels, intensity_image=channel)
+    assert len(properties) == len(regions) > 10
+    scale = np.array((.5, .1, .2))  # As (z, x, y)
+    for spot, region in zip(properties, regions):
+        assert spot['label'] == region.label
+        assert spot['area'] == region.area
+        assert isinstance(spot['centroid'], tuple)
+        assert np.allclose(spot['centroid'], region.centroid)
+        assert np.allclose(spot['weighted_centroid'], region.centroid_weighted)
+        assert np.isclose(spot['max_intensity'], region.intensity_max)
+        assert np.isclose(spot['min_intensity'], region.intensity_min)
+        assert np.isclose(spot['mean_intensity'], region.intensity_mean)
+        assert np.isclose(spot['volume'], region.area * np.prod(scale))
+        assert np.allclose(spot['centroid_physical'], np.array(region.centroid) * scale)
+        assert np.allclose(spot['weighted_centroid_physical'], np.array(region.centroid_weighted) * scale)
+
+
+########## Distances ##########
+
+@pytest.mark.parametrize('remove_mcn', [False, True])
+@pytest.mark.parametrize('pixel_size', [None, (.1, .2, .5)])
+def test_kdtree_and_cdist_distances_agree(remove_mcn, pixel_size):
+    rng = np.random.default_rng(0)
+    positions = [rng.uniform(0, 50, (80, 3)), rng.uniform(0, 50, (60, 3)), np.empty((0, 3)), rng.uniform(0, 50, (5, 3))]
+    sigma = 8 if pixel_size is None else 2
+
+    by_kdtree = toolbox.compute_distances_matrix(positions, sigma, pixel_size, remove_mcn, method='kdtree')
+    by_cdist = toolbox.compute_distances_matrix(positions, sigma, pixel_size, remove_mcn, method='cdist')
+
+    assert [d['channels'] for d in by_kdtree] == [d['channels'] for d in by_cdist]
+    for kdtree, cdist in zip(by_kdtree, by_cdist):
+        assert np.array_equal(kdtree['index_A'], cdist['index_A'])
+        assert np.array_equal(kdtree['index_B'], cdist['index_B'])
+        assert np.allclose(kdtree['dist_3d'], cdist['dist_3d'])
+        assert np.array_equal(np.reshape(kdtree['coord_A'], (-1, 3)), np.reshape(cdist['coord_A'], (-1, 3)))
+    assert len(by_kdtree[0]['index_A']) > 0
+    assert all(len(d['index_A']) == 0 for d in by_kdtree if 2 in d['channels'])
+
+
+def test_distances_are_in_physical_units():
+    positions = [np.array([[1., 10., 10.]]), np.array([[3., 12., 10.]])]  # (z, x, y)
+
+    distances = toolbox.compute_distances_matrix(positions, sigma=10, pixel_size=(.1, .2, .5))
+
+    assert np.allclose(distances[0]['dist_3d'], np.hypot(2 * .5, 2 * .1))
+
+
+########## Contours ##########
+
+def _reference_douglas_peucker(points, tolerance):
+    """The recursive Douglas-Peucker algorithm, returning the flags of the vertices kept"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    if len(points) < 3:
+        return keep
+    direction = points[-1] - points[0]
+    offsets = points[1:-1] - points[0]
+    length = np.hypot(direction[0], direction[1])
+    if length > 0:
+        distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+    else:
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+    farthest = np.argmax(distances) + 1
+    if distances[farthest - 1] > tolerance:
+        keep[:farthest + 1] |= _reference_douglas_peucker(points[:farthest + 1], tolerance)
+        keep[farthest:] |= _reference_douglas_peucker(points[farthest:], tolerance)
+    return keep
+
+
+def _reference_simplify_contour(contour, tolerance, max_vertices):
+    keep = _reference_douglas_peucker(contour, tolerance) if tolerance else np.ones(len(contour), dtype=bool)
+    while max_vertices and np.count_nonzero(keep) - 1 > max_vertices:
+        tolerance = tolerance * 2 if tolerance else .5
+        keep = _reference_douglas_peucker(contour, tolerance)
+    return contour[keep][:-1]
+
+
+def _closed_contours(sizes, seed=0):
+    """Noisy closed polygons, their first vertex repeated at the end, and a contour on the pixel grid"""
+    rng = np.random.default_rng(seed)
+    contours = list()
+    for size in sizes:
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size))
+        radii = rng.uniform(5, 20, size)
+        contour = np.stack([radii * np.cos(angles), radii * np.sin(angles)], axis=1)
+        contours.append(np.concatenate([contour, contour[:1]]))
+    square = [(0, y) for y in range(6)] + [(x, 5) for x in range(1, 6)] + \
+             [(5, y) for y in range(4, -1, -1)] + [(x, 0) for x in range(4, -1, -1)]
+    contours.append(np.array(square, dtype=np.float64))
+    return contours
+
+
+@pytest.mark.parametrize('tolerance, max_vertices', [(1.0, None), (3.0, None), (None, None), (1.0, 8), (None, 5)])
+@pytest.mark.parametrize('sizes', [[60], [3, 40, 200, 1, 12]])
+def test_simplify_contours_matches_the_recursive_algorithm(sizes, tolerance, max_vertices):
+    contours = _closed_contours(sizes)
+
+    simplified = toolbox._simplify_contours(contours, tolerance, max_vertices)
+
+    assert len(simplified) == len(contours)
+    for contour, result in zip(contours, simplified):
+        assert np.array_equal(result, _reference_simplify_contour(contour, tolerance, max_vertices))
+        if max_vertices:
+            assert len(result) <= max_vertices
+
+
+def test_douglas_peucker_uses_a_tolerance_per_polyline():
+    contours = _closed_contours([50, 50, 50])
+    points = np.concatenate(contours)
+    ends = np.cumsum([len(contour) for contour in contours]) - 1
+    bounds = np.stack([ends - [len(contour) - 1 for contour in contours], ends], axis=1)
+    tolerances = [.5, 2., 8., 1.]
+
+    keep = toolbox._douglas_peucker(points, bounds, tolerances)
+
+    for contour, (start, end), tolerance in zip(contours, bounds, tolerances):
+        assert np.array_equal(keep[start:end + 1], _reference_douglas_peucker(contour, tolerance))
+
+
+########## Map annotations ##########
+
+@pytest.mark.parametrize('column', [[1, 2.5], [True, 'a'], [True, 1], [None, 1], ['a', None], [1.5, float('nan')],
+                                    [1, 2], [True, False], np.array([1.5, 2.]), np.array([3, 4], dtype=np.uint8)])
+def test_map_columns_are_serialized_as_single_values(column):
+    values = column.tolist() if isinstance(column, np.ndarray) else column
+    by_column = toolbox._annotation_maps(len(column), columns={'key': column})
+    by_object = toolbox._annotation_maps(len(column), [{'key': value} for value in values])
+
+    assert by_column == by_object
+    assert [value for ((_, value),) in by_column] == [toolbox._serialize_map_value(value) for value in values]
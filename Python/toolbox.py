@@ -4,20 +4,33 @@ from omero import model
 from omero.model import enums, LengthI
 from omero import grid
 from omero import rtypes
-from itertools import product
+from omero.sys import ParametersI
+from itertools import product, chain
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+import logging
 from json import dumps
 from random import choice
 from string import ascii_letters
-from skimage.filters import threshold_otsu, apply_hysteresis_threshold, gaussian
+from skimage.filters import threshold_otsu, apply_hysteresis_threshold
 from skimage.segmentation import clear_border
-from skimage.measure import label, regionprops
+from skimage.measure import label, find_contours
 from skimage.morphology import closing, cube
 from skimage.feature import peak_local_max
 from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import numpy as np
-from itertools import permutations
+from itertools import permutations, combinations
 
 
+logger = logging.getLogger(__name__)
+
 COLUMN_TYPES = {'string': grid.StringColumn,
                 'long': grid.LongColumn,
                 'bool': grid.BoolColumn,
@@ -34,16 +47,55 @@ COLUMN_TYPES = {'string': grid.StringColumn,
                 'file': grid.FileColumn,
                 }
 
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Sets a tracing.Tracer recording the toolbox calls. Set to None to disable tracing.
+    Returns the previous tracer"""
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def _returned_bytes(result):
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (tuple, list)):
+        return sum(r.nbytes for r in result if isinstance(r, np.ndarray))
+    return 0
+
 
-def open_connection(username, password, group, port, host, secure=False):
-    conn = gw.BlitzGateway(username=username,
-                           passwd=password,
-                           group=group,
-                           port=port,
-                           host=host,
-                           secure=secure)
+def _traced(function):
+    """Records the calls to function in the tracer, if one is set"""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return function(*args, **kwargs)
+        with _tracer.span(function.__qualname__) as span:
+            result = function(*args, **kwargs)
+            span.add_allocation(_returned_bytes(result))
+            return result
+    return wrapper
+
+
+def _trace_round_trips(count=1, nbytes=0):
+    """Records calls to the server in the tracer, if one is set"""
+    if _tracer is not None:
+        _tracer.add_round_trips(count, nbytes)
+
+
+@_traced
+def open_connection(username, password, group, port, host, secure=False, gateway_class=gw.BlitzGateway):
+    conn = gateway_class(username=username,
+                         passwd=password,
+                         group=group,
+                         port=port,
+                         host=host,
+                         secure=secure)
     try:
         conn.connect()
+        _trace_round_trips()
     except Exception as e:
         raise e
     return conn
@@ -53,6 +105,174 @@ def close_connection(connection):
     connection.close()
 
 
+class ConnectionPool(object):
+    """A pool of authenticated connections to one OMERO server.
+
+    Only the first connection logs in with the credentials, the other ones join its session.
+    At most max_connections connections are handed out at the same time. Idle connections are
+    pinged every keepalive_interval seconds and broken connections are replaced.
+    eg:
+    with ConnectionPool(username, password, group, port, host) as pool:
+        with pool.connection() as conn:
+            image = get_image(conn, image_id)
+    """
+    def __init__(self, username, password, group, port, host, secure=False,
+                 max_connections=4, keepalive_interval=60, gateway_class=gw.BlitzGateway):
+        self._credentials = {'username': username, 'password': password, 'group': group,
+                             'port': port, 'host': host, 'secure': secure}
+        self.max_connections = max_connections
+        self.keepalive_interval = keepalive_interval
+        self.gateway_class = gateway_class
+
+        self._semaphore = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()  # Guards the pool state. Never held during calls to the server
+        self._login_lock = threading.Lock()  # Makes sure that only one connection logs in at a time
+        self._idle = list()
+        self._in_use = 0
+        self._session_key = None
+        self._closed = False
+
+        self._stop_keepalive = threading.Event()
+        self._keepalive_thread = None
+        if keepalive_interval:
+            self._keepalive_thread = threading.Thread(target=self._keepalive, daemon=True)
+            self._keepalive_thread.start()
+
+    def _join_session(self, session_key):
+        """Returns a new connection to the session or None if the session expired"""
+        conn = self.gateway_class(host=self._credentials['host'],
+                                  port=self._credentials['port'],
+                                  secure=self._credentials['secure'])
+        _trace_round_trips()
+        if conn.connect(sUuid=session_key):
+            return conn
+        return None
+
+    @_traced
+    def _new_connection(self):
+        session_key = self._session_key
+        if session_key is not None:
+            conn = self._join_session(session_key)
+            if conn is not None:
+                return conn
+
+        with self._login_lock:
+            if self._session_key is not None and self._session_key != session_key:
+                conn = self._join_session(self._session_key)  # Another thread logged in meanwhile
+                if conn is not None:
+                    return conn
+            conn = open_connection(gateway_class=self.gateway_class, **self._credentials)
+            if not conn.isConnected():
+                raise ConnectionError(f'Could not connect to {self._credentials["host"]}')
+            self._session_key = conn.getEventContext().sessionUuid
+
+        return conn
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            _trace_round_trips()
+            return conn.keepAlive()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(conn, hard=False):
+        try:
+            conn.close(hard=hard)  # Unless hard, do not kill the session shared with the other connections
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """Returns an authenticated connection. Blocks if max_connections connections are in use"""
+        if self._closed:
+            raise RuntimeError('The connection pool is closed')
+        if not self._semaphore.acquire(timeout=timeout):
+            raise TimeoutError('No connection available in the pool')
+        with self._lock:
+            self._in_use += 1
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._new_connection()
+                if self._is_alive(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._check_in(None)
+            raise
+
+    def _check_in(self, conn, alive=False):
+        """Frees the slot of a connection, keeping conn as idle if it is alive and the pool is open.
+        Once the pool is closed, the last connection checked in closes the session"""
+        with self._lock:
+            self._in_use -= 1
+            keep = conn is not None and alive and not self._closed
+            if keep:
+                self._idle.append(conn)
+            last = self._closed and not self._in_use
+        if conn is not None and not keep:
+            self._discard(conn, hard=last)
+        self._semaphore.release()
+
+    def release(self, conn):
+        """Returns a connection to the pool. It is not pinged: a broken connection is found and replaced
+        by the next acquire or by the keepalive"""
+        self._check_in(conn, alive=not self._closed)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout=timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def _keepalive(self):
+        while not self._stop_keepalive.wait(self.keepalive_interval):
+            with self._lock:
+                idle = list(self._idle)
+            dead = [conn for conn in idle if not self._is_alive(conn)]
+            with self._lock:
+                dead = [conn for conn in dead if conn in self._idle]  # Skip those acquired in the meantime
+                self._idle = [conn for conn in self._idle if conn not in dead]
+            for conn in dead:
+                self._discard(conn)
+
+    def close(self):
+        """Closes all idle connections. The session is closed as well if no connection is in use,
+        otherwise when the last connection in use is released"""
+        self._stop_keepalive.set()
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+            in_use = self._in_use
+        session_conn = idle.pop() if idle and not in_use else None
+        if session_conn is not None and not self._is_alive(session_conn):
+            idle.append(session_conn)
+            session_conn = None
+        for conn in idle:
+            self._discard(conn)
+        if in_use:
+            return
+
+        if session_conn is None and self._session_key is not None:
+            try:
+                session_conn = self._join_session(self._session_key)
+            except Exception:
+                pass
+        if session_conn is not None:
+            self._discard(session_conn, hard=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def get_image(connection, image_id):
     try:
         image = connection.getObject('Image', image_id)
@@ -77,7 +297,16 @@ def get_project(connection, project_id):
     return project
 
 
-def get_image_shape(image):
+def get_image_shape(image, catalogue=None):
+    """Returns the shape of the image as (z, c, t, x, y).
+    If a catalogue (see get_dataset_catalogue) containing the image is provided, the server is not queried"""
+    entry = _get_catalogue_entry(catalogue, image)
+    if entry is not None:
+        return (int(entry['size_z']),
+                int(entry['size_c']),
+                int(entry['size_t']),
+                int(entry['size_x']),
+                int(entry['size_y']))
     try:
         image_shape = (image.getSizeZ(),
                        image.getSizeC(),
@@ -90,7 +319,12 @@ def get_image_shape(image):
     return image_shape
 
 
-def get_pixel_sizes(image):
+def get_pixel_sizes(image, catalogue=None):
+    entry = _get_catalogue_entry(catalogue, image)
+    if entry is not None:
+        return (float(entry['physical_size_x']),
+                float(entry['physical_size_y']),
+                float(entry['physical_size_z']))
     pixels = image.getPrimaryPixels()
 
     pixel_sizes = (pixels.getPhysicalSizeX().getValue(),
@@ -99,7 +333,12 @@ def get_pixel_sizes(image):
     return pixel_sizes
 
 
-def get_pixel_units(image):
+def get_pixel_units(image, catalogue=None):
+    entry = _get_catalogue_entry(catalogue, image)
+    if entry is not None:
+        return (str(entry['physical_size_x_unit']),
+                str(entry['physical_size_y_unit']),
+                str(entry['physical_size_z_unit']))
     pixels = image.getPrimaryPixels()
 
     pixel_size_units = (pixels.getPhysicalSizeX().getUnit().name,
@@ -108,18 +347,23 @@ def get_pixel_units(image):
     return pixel_size_units
 
 
-def get_intensities(image, z_range=None, c_range=None, t_range=None, x_range=None, y_range=None):
-    """Returns a numpy array containing the intensity values of the image
-    Returns an array with dimensions arranged as zctxy
-    """
-    image_shape = get_image_shape(image)
-
-    # Decide if we are going to call getPlanes or getTiles
-    if not x_range and not y_range:
-        whole_planes = True
+def _to_data_type(pixels_type_value, bit_size):
+    if pixels_type_value == 'float':
+        data_type = pixels_type_value + str(bit_size)  # TODO: Verify this is working for all data types
     else:
-        whole_planes = False
+        data_type = pixels_type_value
+
+    return data_type
+
+
+def _get_data_type(pixels):
+    pixels_type = pixels.getPixelsType()
 
+    return _to_data_type(pixels_type.value, pixels_type.bitSize)
+
+
+def _get_ranges(image_shape, z_range=None, c_range=None, t_range=None, x_range=None, y_range=None):
+    """Converts the range arguments of get_intensities into a list of zctxy range objects"""
     ranges = list(range(5))
     for dim, r in enumerate([z_range, c_range, t_range, x_range, y_range]):
         # Verify that requested ranges are within the available data
@@ -142,33 +386,335 @@ def get_intensities(image, z_range=None, c_range=None, t_range=None, x_range=Non
             if not 1 <= ranges[dim].stop <= image_shape[dim]:
                 raise IndexError('Specified range is outside of the image dimensions')
 
+    return ranges
+
+
+def _split_range(start, stop, tile_length):
+    """Splits [start, stop) into pieces whose boundaries are aligned to multiples of tile_length"""
+    pieces = list()
+    while start < stop:
+        end = min((start // tile_length + 1) * tile_length, stop)
+        pieces.append((start, end))
+        start = end
+
+    return pieces
+
+
+@_traced
+def _fetch_planes_chunk(pixels, zct_chunk, tile_region, offset, out, cache=None, cache_key=None):
+    """Fetches a tile_region (x, y, width, height) for a list of (plane_index, z, c, t) and
+    writes it directly into out, a (planes, y, x) array starting at the pixel offset (x, y).
+    If a cache is provided, tiles are looked up under cache_key + (z, c, t, tile_region) first"""
+    x_start, y_start, width, height = tile_region
+    y_start_out = y_start - offset[1]
+    x_start_out = x_start - offset[0]
+
+    def out_slot(index):
+        return out[index, y_start_out:y_start_out + height, x_start_out:x_start_out + width]
+
+    if cache is not None:
+        zct_chunk = [(index, z, c, t) for index, z, c, t in zct_chunk
+                     if cache.get(cache_key + (z, c, t, tile_region), out=out_slot(index)) is None]
+        if not zct_chunk:
+            return
+
+    zct_tile_list = [(z, c, t, tile_region) for _, z, c, t in zct_chunk]
+    # getTiles opens its own raw pixels store, so every chunk uses a separate session
+    for (index, z, c, t), tile in zip(zct_chunk, pixels.getTiles(zctTileList=zct_tile_list)):
+        _trace_round_trips(nbytes=tile.nbytes)
+        out_slot(index)[...] = tile
+        if cache is not None:
+            cache.put(cache_key + (z, c, t, tile_region), tile)
+
+
+def _fetch_planes(pixels, zct_list, x_range, y_range, out, workers=4, planes_per_chunk=4, tile_size=(1024, 1024),
+                  cache=None, cache_key=None):
+    """Splits the requested planes and xy region into work units and fetches them concurrently.
+    Tiles are aligned to multiples of tile_size (x, y)"""
+    indexed_zct = [(i, z, c, t) for i, (z, c, t) in enumerate(zct_list)]
+    zct_chunks = [indexed_zct[i:i + planes_per_chunk] for i in range(0, len(indexed_zct), planes_per_chunk)]
+    tile_regions = [(x_start, y_start, x_end - x_start, y_end - y_start)
+                    for y_start, y_end in _split_range(y_range.start, y_range.stop, tile_size[1])
+                    for x_start, x_end in _split_range(x_range.start, x_range.stop, tile_size[0])]
+    offset = (x_range.start, y_range.start)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_fetch_planes_chunk, pixels, zct_chunk, tile_region, offset, out, cache, cache_key)
+                   for zct_chunk in zct_chunks for tile_region in tile_regions]
+        for future in futures:
+            future.result()  # Raises any exception from the workers
+
+
+_pixel_cache = None
+
+
+def set_pixel_cache(cache):
+    """Sets a default pixel_cache.PixelCache used by get_intensities. Set to None to disable caching
+    eg: set_pixel_cache(PixelCache('/tmp/omero_pixels', max_bytes=10 * 1024**3))"""
+    global _pixel_cache
+    _pixel_cache = cache
+
+
+_pyramid_store = None
+
+
+def set_pyramid_store(store):
+    """Sets the pyramid.PyramidStore holding the local multi-resolution copies of images read by
+    get_intensities when a resolution level is requested. Set to None to disable it"""
+    global _pyramid_store
+    _pyramid_store = store
+
+
+def _get_cache_key(image, pixels):
+    """Identifies the pixel data of an image. The key changes when the pixels are updated on the server"""
+    update_event = pixels._obj.getDetails().getUpdateEvent()
+    update_event_id = update_event.getId().getValue() if update_event is not None else None
+    return image.getId(), update_event_id
+
+
+@_traced
+def get_intensities(image, z_range=None, c_range=None, t_range=None, x_range=None, y_range=None,
+                    workers=1, planes_per_chunk=4, tile_size=None, cache=None, level=0):
+    """Returns a numpy array containing the intensity values of the image
+    Returns an array with dimensions arranged as zctxy
+
+    If workers is larger than 1 or a tile_size (x, y) is given, planes are fetched in chunks of
+    planes_per_chunk planes and tiles aligned to tile_size over a pool of workers, each chunk being
+    written directly into the output array.
+    If a cache (see pixel_cache.PixelCache) is provided or set with set_pixel_cache, tiles are
+    read from the cache when available and stored into it otherwise.
+    If a level larger than 0 is requested, the intensities are read from the local multi-resolution copy
+    of the image in the store set with set_pyramid_store, level n being downsampled 2**n times (with the
+    default factor). x_range and y_range are then in the coordinates of that level.
+    """
+    if level:
+        return _get_pyramid_intensities(image, level, z_range, c_range, t_range, x_range, y_range)
+
+    image_shape = get_image_shape(image)
+
+    # Decide if we are going to call getPlanes or getTiles
+    if not x_range and not y_range:
+        whole_planes = True
+    else:
+        whole_planes = False
+
+    ranges = _get_ranges(image_shape, z_range, c_range, t_range, x_range, y_range)
+
     output_shape = (len(ranges[0]), len(ranges[1]), len(ranges[2]), len(ranges[3]), len(ranges[4]))
     nr_planes = output_shape[0] * output_shape[1] * output_shape[2]
     zct_list = list(product(ranges[0], ranges[1], ranges[2]))
 
     pixels = image.getPrimaryPixels()
-    pixels_type = pixels.getPixelsType()
-    if pixels_type.value == 'float':
-        data_type = pixels_type.value + str(pixels_type.bitSize)  # TODO: Verify this is working for all data types
-    else:
-        data_type = pixels_type.value
+    data_type = _get_data_type(pixels)
 
     intensities = np.zeros((nr_planes,
                             output_shape[3],
                             output_shape[4]),
                            dtype=data_type)
-    if whole_planes:
-        np.stack(list(pixels.getPlanes(zctList=zct_list)), out=intensities)
+    # Planes come from the server as (y, x) so we write them through a transposed view
+    planes_view = intensities.transpose((0, 2, 1))
+    if cache is None:
+        cache = _pixel_cache
+    if workers > 1 or tile_size is not None or cache is not None:
+        _fetch_planes(pixels, zct_list, ranges[3], ranges[4], planes_view,
+                      workers=workers, planes_per_chunk=planes_per_chunk, tile_size=tile_size or (1024, 1024),
+                      cache=cache, cache_key=_get_cache_key(image, pixels) if cache is not None else None)
+    elif whole_planes:
+        np.stack(list(pixels.getPlanes(zctList=zct_list)), out=planes_view)
+        _trace_round_trips(nr_planes, intensities.nbytes)
     else:
         tile_region = (ranges[3].start, ranges[4].start, len(ranges[3]), len(ranges[4]))
         zct_tile_list = [(z, c, t, tile_region) for z, c, t in zct_list]
-        np.stack(list(pixels.getTiles(zctTileList=zct_tile_list)), out=intensities)
+        np.stack(list(pixels.getTiles(zctTileList=zct_tile_list)), out=planes_view)
+        _trace_round_trips(nr_planes, intensities.nbytes)
 
     intensities = np.reshape(intensities, newshape=output_shape)
 
     return intensities
 
 
+def _get_pyramid_intensities(image, level, z_range=None, c_range=None, t_range=None, x_range=None, y_range=None):
+    if _pyramid_store is None or image.getId() not in _pyramid_store:
+        raise Exception(f'There is no multi-resolution copy of image {image.getId()}. Use set_pyramid_store')
+    if level >= _pyramid_store.nr_levels(image.getId()):
+        raise IndexError(f'Level {level} is not available for image {image.getId()}')
+
+    ranges = _get_ranges(_pyramid_store.shape(image.getId(), level), z_range, c_range, t_range, x_range, y_range)
+    output_shape = tuple(len(r) for r in ranges)
+    zct_list = list(product(ranges[0], ranges[1], ranges[2]))
+    intensities = np.empty((len(zct_list), output_shape[3], output_shape[4]),
+                           dtype=_pyramid_store.dtype(image.getId(), level))
+    # As in get_intensities, the stored (y, x) planes are read through a transposed view
+    _pyramid_store.read(image.getId(), level, zct_list, ranges[3], ranges[4], out=intensities.transpose((0, 2, 1)))
+    _trace_round_trips(0, intensities.nbytes)
+
+    return np.reshape(intensities, newshape=output_shape)
+
+
+def get_tile_size(image):
+    """Returns the (x, y) tile size the server uses to store the pixels of the image"""
+    raw_pixels_store = image.getPrimaryPixels()._prepareRawPixelsStore()
+    try:
+        tile_size = tuple(raw_pixels_store.getTileSize())
+    finally:
+        raw_pixels_store.close()
+
+    return tile_size
+
+
+class LazyIntensities(object):
+    """A lazy, read-only array view over the intensities of an image with dimensions arranged as zctxy.
+    Nothing is fetched from the server until the view is indexed or reduced. Indexing with integers
+    and slices returns the same values as indexing the array returned by get_intensities for the
+    whole image. Reductions (max, min, sum, mean) are computed one z plane at a time so memory stays bounded.
+    """
+    def __init__(self, image, tile_size=None, workers=1, planes_per_chunk=4, cache=None):
+        self.image = image
+        self.shape = get_image_shape(image)
+        self.dtype = np.dtype(_get_data_type(image.getPrimaryPixels()))
+        self.tile_size = tile_size or get_tile_size(image)
+        self.chunks = (1, 1, 1) + tuple(self.tile_size)
+        self.workers = workers
+        self.planes_per_chunk = planes_per_chunk
+        self.cache = cache
+
+    ndim = 5
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'LazyIntensities(image_id={self.image.getId()}, shape={self.shape}, dtype={self.dtype})'
+
+    def __array__(self, dtype=None, copy=None):
+        intensities = self[...]
+        if dtype is not None:
+            intensities = intensities.astype(dtype)
+        return intensities
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            position = key.index(Ellipsis)
+            key = key[:position] + (slice(None),) * (self.ndim - len(key) + 1) + key[position + 1:]
+        if len(key) > self.ndim:
+            raise IndexError('Too many indices for a zctxy array')
+        key = key + (slice(None),) * (self.ndim - len(key))
+        for k in key:
+            if not isinstance(k, (slice, int, np.integer)):
+                raise TypeError('Only integers, slices and Ellipsis are supported')
+
+        return key
+
+    def __getitem__(self, key):
+        key = self._normalize_key(key)
+
+        indexes = list()  # The indexes requested along every dimension
+        for dim, (k, size) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                indexes.append(range(*k.indices(size)))
+            else:
+                if not -size <= k < size:
+                    raise IndexError(f'Index {k} is out of bounds for axis {dim} with size {size}')
+                indexes.append(int(k) % size)
+
+        result_shape = tuple(len(i) for i in indexes if isinstance(i, range))
+        if 0 in result_shape:
+            return np.zeros(result_shape, dtype=self.dtype)
+
+        fetch_ranges = list()
+        fetch_offsets = list()
+        for dim, index in enumerate(indexes):
+            if isinstance(index, int):
+                fetch_ranges.append((index, index + 1))
+                fetch_offsets.append((index, 1))
+                continue
+            first, last = min(index[0], index[-1]), max(index[0], index[-1])
+            if dim < 3:  # z, c and t are fetched with their step
+                fetch_ranges.append((first, last + 1, abs(index.step)))
+                fetch_offsets.append((first, abs(index.step)))
+            else:  # x and y are fetched as a contiguous region
+                fetch_ranges.append((first, last + 1))
+                fetch_offsets.append((first, 1))
+
+        z_range, c_range, t_range, x_range, y_range = fetch_ranges
+        intensities = get_intensities(self.image, z_range, c_range, t_range, x_range, y_range,
+                                      workers=self.workers,
+                                      planes_per_chunk=self.planes_per_chunk,
+                                      tile_size=self.tile_size,
+                                      cache=self.cache)
+
+        # Select the requested indexes relative to what was fetched, starting from the last dimension
+        for dim in reversed(range(self.ndim)):
+            offset, step = fetch_offsets[dim]
+            index = indexes[dim]
+            if isinstance(index, int):
+                intensities = np.take(intensities, (index - offset) // step, axis=dim)
+            else:
+                relative = (np.asarray(index) - offset) // step
+                if not np.array_equal(relative, np.arange(intensities.shape[dim])):
+                    intensities = np.take(intensities, relative, axis=dim)
+
+        return intensities
+
+    def _reduce(self, ufunc, axis=None, dtype=None):
+        """Reduces along axis with ufunc fetching one z plane at a time"""
+        if axis is not None:
+            axis = axis % self.ndim
+        reduced = list()
+        for z in range(self.shape[0]):
+            z_slab = self[z]
+            if axis is None:
+                z_reduced = ufunc.reduce(z_slab, axis=None, dtype=dtype)
+            elif axis == 0:
+                z_reduced = z_slab.astype(dtype or z_slab.dtype, copy=False)
+            else:
+                z_reduced = ufunc.reduce(z_slab, axis=axis - 1, dtype=dtype)
+
+            if axis in (None, 0):
+                # Accumulate so we only keep a single z plane in memory
+                reduced = z_reduced if z == 0 else ufunc(reduced, z_reduced)
+            else:
+                reduced.append(z_reduced)
+
+        if axis not in (None, 0):
+            reduced = np.stack(reduced)
+
+        return reduced
+
+    def max(self, axis=None):
+        return self._reduce(np.maximum, axis)
+
+    def min(self, axis=None):
+        return self._reduce(np.minimum, axis)
+
+    def sum(self, axis=None):
+        # Same accumulator type numpy uses when summing this dtype
+        return self._reduce(np.add, axis, dtype=np.add.reduce(np.zeros(1, dtype=self.dtype)).dtype)
+
+    def mean(self, axis=None):
+        count = self.size if axis is None else self.shape[axis]
+        return self.sum(axis) / count
+
+
+@_traced
+def get_lazy_intensities(image, tile_size=None, workers=1, planes_per_chunk=4, cache=None):
+    """Returns a lazy zctxy view over the intensities of the image. Planes and tiles are only
+    fetched when the view is sliced or reduced, in chunks aligned to the server tiles.
+    eg: get_lazy_intensities(image).max(axis=0) computes a maximum intensity projection plane by plane
+    """
+    return LazyIntensities(image, tile_size=tile_size, workers=workers, planes_per_chunk=planes_per_chunk, cache=cache)
+
+
 ############### Creating projects and datasets #####################
 
 def create_project(connection, project_name):
@@ -208,6 +754,100 @@ def get_dataset_images(dataset):
     return images
 
 
+_CATALOGUE_QUERY = """
+    select image.id, dataset.id, image.name,
+           pixels.sizeZ, pixels.sizeC, pixels.sizeT, pixels.sizeX, pixels.sizeY,
+           pixelsType.value, pixelsType.bitSize,
+           pixels.physicalSizeX.value, pixels.physicalSizeY.value, pixels.physicalSizeZ.value,
+           pixels.physicalSizeX.unit, pixels.physicalSizeY.unit, pixels.physicalSizeZ.unit
+    from {links}
+    join datasetImageLink.child image
+    join image.pixels pixels
+    join pixels.pixelsType pixelsType
+    where {parent}.id = :id
+    order by image.id, dataset.id
+    """
+
+
+def _unit_name(unit):
+    unit = rtypes.unwrap(unit)
+    return getattr(unit, 'name', unit) or ''
+
+
+def _query_catalogue(connection, query, object_id, page_size):
+    query_service = connection.getQueryService()
+    rows = list()
+    while True:
+        params = ParametersI()
+        params.addId(object_id)
+        params.page(len(rows), page_size)
+        page = query_service.projection(query, params, connection.SERVICE_OPTS)
+        _trace_round_trips()
+        rows.extend(rtypes.unwrap(page))
+        if len(page) < page_size:
+            break
+
+    name_length = max([len(row[2]) for row in rows], default=1)
+    catalogue = np.zeros(len(rows), dtype=[('image_id', 'i8'),
+                                           ('dataset_id', 'i8'),
+                                           ('name', f'U{name_length}'),
+                                           ('size_z', 'i4'),
+                                           ('size_c', 'i4'),
+                                           ('size_t', 'i4'),
+                                           ('size_x', 'i4'),
+                                           ('size_y', 'i4'),
+                                           ('data_type', 'U8'),
+                                           ('physical_size_x', 'f8'),
+                                           ('physical_size_y', 'f8'),
+                                           ('physical_size_z', 'f8'),
+                                           ('physical_size_x_unit', 'U16'),
+                                           ('physical_size_y_unit', 'U16'),
+                                           ('physical_size_z_unit', 'U16'),
+                                           ])
+    for i, row in enumerate(rows):
+        catalogue[i] = tuple(row[:8] +
+                             [_to_data_type(row[8], row[9])] +
+                             [np.nan if v is None else v for v in row[10:13]] +
+                             [_unit_name(u) for u in row[13:16]])
+
+    return catalogue
+
+
+@_traced
+def get_dataset_catalogue(connection, dataset_id, page_size=1000):
+    """Returns a numpy structured array with the metadata of all the images in a dataset, sorted by image id:
+    image_id, dataset_id, name, size_z, size_c, size_t, size_x, size_y, data_type,
+    physical_size_x, physical_size_y, physical_size_z (nan when not set) and their units.
+    The metadata is fetched with one query per page_size images.
+    """
+    query = _CATALOGUE_QUERY.format(links='DatasetImageLink datasetImageLink join datasetImageLink.parent dataset',
+                                    parent='dataset')
+    return _query_catalogue(connection, query, dataset_id, page_size)
+
+
+@_traced
+def get_project_catalogue(connection, project_id, page_size=1000):
+    """Returns a numpy structured array with the metadata of all the images in all datasets of a project.
+    See get_dataset_catalogue"""
+    query = _CATALOGUE_QUERY.format(links='ProjectDatasetLink projectDatasetLink '
+                                          'join projectDatasetLink.parent project '
+                                          'join projectDatasetLink.child dataset '
+                                          'join dataset.imageLinks datasetImageLink',
+                                    parent='project')
+    return _query_catalogue(connection, query, project_id, page_size)
+
+
+def _get_catalogue_entry(catalogue, image):
+    """Returns the catalogue entry of an image (or image id) or None if it is not in the catalogue"""
+    if catalogue is None:
+        return None
+    image_id = image if isinstance(image, (int, np.integer)) else image.getId()
+    index = np.searchsorted(catalogue['image_id'], image_id)
+    if index < len(catalogue) and catalogue['image_id'][index] == image_id:
+        return catalogue[index]
+    return None
+
+
 # In this section we give some convenience functions to send data back to OMERO #
 
 def create_annotation_tag(connection, tag_string):
@@ -260,6 +900,173 @@ def create_annotation_map(connection, annotation, client_editable=True):
     return map_ann
 
 
+def _serialize_map_values(values):
+    """Serializes a sequence of values as _serialize_map_value does. Arrays of strings, booleans and numbers,
+    and lists whose values are all of one of these types, are converted at once"""
+    if not isinstance(values, np.ndarray):
+        # Converting values of mixed types to an array would promote them (eg: [True, 1] to [1, 1])
+        types = {type(v) for v in values}
+        if len(types) != 1 or types.pop() not in (str, bool, int, float):
+            return [_serialize_map_value(v) for v in values]
+    array = np.asarray(values)
+    kind = array.dtype.kind
+    if array.ndim != 1:
+        return [_serialize_map_value(v) for v in values]
+    if kind in 'US':
+        return array.astype(str).tolist()
+    if kind == 'b':
+        return np.where(array, 'true', 'false').tolist()
+    if kind in 'iu':
+        return array.astype(str).tolist()
+    if kind == 'f':
+        serialized = list(map(float.__repr__, array.astype(np.float64).tolist()))  # As json.dumps does
+        for i in np.flatnonzero(~np.isfinite(array)).tolist():
+            serialized[i] = dumps(float(array[i]))
+        return serialized
+    return [_serialize_map_value(v) for v in values]
+
+
+def _is_key_value_pair(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[0], str)
+
+
+def _annotation_maps(nr_objects, annotations=None, columns=None):
+    """Returns, for every object, its map annotation as a tuple of (key, value) string pairs"""
+    if (annotations is None) == (columns is None):
+        raise Exception('Either annotations or columns have to be provided')
+    if columns is not None:
+        for key, values in columns.items():
+            if len(values) != nr_objects:
+                raise Exception(f'Column {key} has {len(values)} values for {nr_objects} objects')
+        serialized = [_serialize_map_values(values) for values in columns.values()]
+        return [tuple(zip(columns.keys(), row)) for row in zip(*serialized)]
+
+    if isinstance(annotations, dict):
+        annotations = [annotations] * nr_objects  # The same annotation for all the objects
+    elif annotations and _is_key_value_pair(annotations[0]):
+        annotations = [annotations] * nr_objects
+    if len(annotations) != nr_objects:
+        raise Exception(f'Could not match {len(annotations)} annotations to {nr_objects} objects')
+
+    pairs = [list(a.items()) if isinstance(a, dict) else [tuple(kv) for kv in a] for a in annotations]
+    keys = [k for object_pairs in pairs for k, _ in object_pairs]
+    values = [v for object_pairs in pairs for _, v in object_pairs]
+    serialized = _serialize_map_values(values)
+
+    maps = list()
+    start = 0
+    for object_pairs in pairs:
+        maps.append(tuple(zip(keys[start:start + len(object_pairs)], serialized[start:start + len(object_pairs)])))
+        start += len(object_pairs)
+
+    return maps
+
+
+def _link_class(object_wrapper):
+    """Returns the parent model object and the annotation link class of a wrapper, eg: ImageAnnotationLinkI"""
+    obj_class = object_wrapper._obj.__class__
+    class_name = obj_class.__name__[:-1]  # eg: ImageI -> Image
+
+    return obj_class(object_wrapper.getId(), False), getattr(model, f'{class_name}AnnotationLinkI')
+
+
+def _save_in_batches(connection, objects, batch_size):
+    update_service = connection.getUpdateService()
+    saved = list()
+    for start in range(0, len(objects), batch_size):
+        saved.extend(update_service.saveAndReturnArray(objects[start:start + batch_size]))
+        _trace_round_trips()
+
+    return saved
+
+
+def get_annotation_ids(connection, objects, namespace):
+    """Returns the ids of the annotations in namespace linked to any of the objects in a single query
+    per object type"""
+    annotation_ids = set()
+    by_type = dict()
+    for obj in objects:
+        by_type.setdefault(obj._obj.__class__.__name__[:-1], list()).append(obj.getId())
+    query_service = connection.getQueryService()
+    for class_name, ids in by_type.items():
+        params = ParametersI()
+        params.addIds(ids)
+        params.addString('ns', namespace)
+        result = query_service.projection(f'select link.child.id from {class_name}AnnotationLink link '
+                                          f'where link.parent.id in (:ids) and link.child.ns = :ns',
+                                          params, connection.SERVICE_OPTS)
+        _trace_round_trips()
+        annotation_ids.update(rtypes.unwrap(row)[0] for row in result)
+
+    return sorted(annotation_ids)
+
+
+def delete_annotations(connection, objects, namespace):
+    """Deletes, in a single call, the annotations in namespace linked to any of the objects.
+    Annotations shared with other objects are deleted for them too. Returns the deleted ids"""
+    annotation_ids = get_annotation_ids(connection, objects, namespace)
+    if annotation_ids:
+        connection.deleteObjects('Annotation', annotation_ids, wait=True)
+        _trace_round_trips()
+
+    return annotation_ids
+
+
+@_traced
+def link_annotations(connection, objects, annotation_ids, batch_size=1000):
+    """Links the annotation with id annotation_ids[i] to objects[i], saving the links in batches of batch_size"""
+    links = list()
+    for obj, annotation_id in zip(objects, annotation_ids):
+        parent, link_class = _link_class(obj)
+        link = link_class()
+        link.setParent(parent)
+        link.setChild(model.AnnotationI(annotation_id, False))
+        links.append(link)
+
+    return _save_in_batches(connection, links, batch_size)
+
+
+@_traced
+def create_annotations_map(connection, objects, annotations=None, namespace=None, replace=False, client_editable=True,
+                           batch_size=1000, columns=None):
+    """Creates map annotations on many objects (eg: images) in a few calls.
+    annotations is either:
+    - a single dictionary or list of key:value pairs, shared by all the objects
+    - a list with a dictionary or list of key:value pairs for every object
+    Alternatively, columns is a dictionary with, under every key, a list or array of the values of every object
+    eg: create_annotations_map(conn, images, columns={'sharpness': scores, 'in_focus': scores > 10})
+    Values are serialized as in create_annotation_map, whole columns at once when possible.
+    Identical annotations are created once and linked to all their objects.
+    Annotations and links are saved in batches of batch_size.
+    If replace is True, the annotations in namespace linked to the objects are deleted first, in a single call.
+    Returns the id of the annotation of every object
+    """
+    objects = list(objects)
+    if namespace is None and client_editable:
+        namespace = metadata.NSCLIENTMAPANNOTATION  # This makes the annotation editable in the client
+    if replace:
+        if namespace is None:
+            raise Exception('A namespace is needed to replace annotations')
+        delete_annotations(connection, objects, namespace)
+
+    maps = _annotation_maps(len(objects), annotations, columns)
+    unique_maps = list(dict.fromkeys(maps))
+    map_annotations = list()
+    for key_values in unique_maps:
+        map_ann = model.MapAnnotationI()
+        if namespace is not None:
+            map_ann.setNs(rtypes.rstring(namespace))
+        map_ann.setMapValue([model.NamedValue(k, v) for k, v in key_values])
+        map_annotations.append(map_ann)
+    saved = _save_in_batches(connection, map_annotations, batch_size)
+    ids = {key_values: ann.getId().getValue() for key_values, ann in zip(unique_maps, saved)}
+
+    annotation_ids = [ids[key_values] for key_values in maps]
+    link_annotations(connection, objects, annotation_ids, batch_size=batch_size)
+
+    return annotation_ids
+
+
 def create_annotation_file_local(connection, file_path, namespace=None, description=None):
     """Creates a file annotation and uploads it to OMERO"""
 
@@ -276,51 +1083,194 @@ def _create_column(data_type, kwargs):
     return column_class(**kwargs)
 
 
-def _create_table(column_names, columns_descriptions, values):
+# The numpy dtype the values of every column type are converted to before being sent to the server
+COLUMN_DTYPES = {'long': np.int64,
+                 'bool': np.bool_,
+                 'double': np.float64,
+                 'long_array': np.int64,
+                 'float_array': np.float32,
+                 'double_array': np.float64,
+                 'image': np.int64,
+                 'dataset': np.int64,
+                 'plate': np.int64,
+                 'well': np.int64,
+                 'roi': np.int64,
+                 'mask': np.int64,
+                 'file': np.int64,
+                 }
+
+
+def _get_column_type(v):
+    """Infers the (type, size) of a column from the numpy dtype of its values.
+    size is the maximum string length for string columns and the length of the arrays for array columns"""
+    values = np.asarray(v)
+    if values.size == 0:
+        raise Exception('Could not detect column datatype of an empty column')
+    kind = values.dtype.kind
+    if values.ndim == 1:
+        if kind == 'b':
+            return 'bool', None
+        elif kind in 'iu':
+            return 'long', None
+        elif kind == 'f':
+            return 'double', None
+        elif kind in 'US':
+            # For arrays built from lists of strings, the dtype itemsize is the length of the longest string
+            return 'string', max(1, values.dtype.itemsize // np.dtype(f'{kind}1').itemsize)
+    elif values.ndim == 2:  # Every row contains an array of the same length
+        if kind in 'biu':
+            return 'long_array', values.shape[1]
+        elif kind == 'f':
+            return 'float_array' if values.dtype == np.float32 else 'double_array', values.shape[1]
+
+    raise Exception(f'Could not detect column datatype for {values.dtype} with {values.ndim} dimensions')
+
+
+def _get_table_schema(values):
+    """Returns a list with the (type, size) of every column"""
+    return [_get_column_type(v) for v in values]
+
+
+def _normalize_schema(schema):
+    """Returns the schema as a list of (type, size), size being None for columns without size"""
+    return [(column_type, None) if isinstance(column_type, str) else tuple(column_type) for column_type in schema]
+
+
+def _to_column_values(values, data_type):
+    """Converts the values of a column into the list the server expects. Whole columns are converted at once
+    and the values are not copied when they are already a numpy array of the right dtype"""
+    values = np.asarray(values)
+    if data_type in COLUMN_DTYPES:
+        values = values.astype(COLUMN_DTYPES[data_type], copy=False)
+    return values.tolist()
+
+
+def _create_columns(column_names, columns_descriptions, schema, values=None):
+    """Creates the table columns from a schema. If values are not provided, the columns are created empty"""
+    if values is None:
+        values = [list() for _ in column_names]
     columns = list()
-    for cn, cd, v in zip(column_names, columns_descriptions, values):
-        if isinstance(v[0], str):
-            size = len(max(v, key=len))
-            args = {'name': cn, 'description': cd, 'size': size, 'values': v}
-            columns.append(_create_column(data_type='string', kwargs=args))
-        elif isinstance(v[0], int):
-            args = {'name': cn, 'description': cd, 'values': v}
-            columns.append(_create_column(data_type='long', kwargs=args))
-        elif isinstance(v[0], float):
-            args = {'name': cn, 'description': cd, 'values': v}
-            columns.append(_create_column(data_type='double', kwargs=args))
-        elif isinstance(v[0], bool):
-            args = {'name': cn, 'description': cd, 'values': v}
-            columns.append(_create_column(data_type='string', kwargs=args))
-        else:
-            raise Exception(f'Could not detect column datatype for {v[0]}')
+    for cn, cd, (data_type, size), v in zip(column_names, columns_descriptions, _normalize_schema(schema), values):
+        args = {'name': cn, 'description': cd, 'values': _to_column_values(v, data_type)}
+        if size is not None:
+            args['size'] = size
+        columns.append(_create_column(data_type=data_type, kwargs=args))
 
     return columns
 
 
-def create_annotation_table(connection, table_name, column_names, column_descriptions, values, namespace=None, description=None):
-    """Creates a table annotation from a list of lists"""
+def _create_table(column_names, columns_descriptions, values):
+    return _create_columns(column_names=column_names,
+                           columns_descriptions=columns_descriptions,
+                           schema=_get_table_schema(values),
+                           values=values)
 
-    table_name = f'{table_name}_{"".join([choice(ascii_letters) for n in range(32)])}.h5'
 
-    columns = _create_table(column_names=column_names,
-                            columns_descriptions=column_descriptions,
-                            values=values)
+def _new_table(connection, table_name):
+    """Creates a new empty table in the first repository of the server"""
+    table_name = f'{table_name}_{"".join([choice(ascii_letters) for n in range(32)])}.h5'
     resources = connection.c.sf.sharedResources()
     repository_id = resources.repositories().descriptions[0].getId().getValue()
-    table = resources.newTable(repository_id, table_name)
-    table.initialize(columns)
-    table.addData(columns)
+    _trace_round_trips(3)
 
-    original_file = table.getOriginalFile()
-    table.close()  # when we are done, close.
+    return resources.newTable(repository_id, table_name)
+
+
+def _create_table_annotation(connection, original_file):
     file_ann = gw.FileAnnotationWrapper(connection)
     file_ann.setNs(namespaces.NSBULKANNOTATIONS)
     file_ann.setFile(model.OriginalFileI(original_file.id.val, False))  # TODO: try to get this with a wrapper
     file_ann.save()
+    _trace_round_trips()
     return file_ann
 
 
+@_traced
+def create_annotation_table(connection, table_name, column_names, column_descriptions, values, namespace=None, description=None):
+    """Creates a table annotation from a list of lists"""
+
+    columns = _create_table(column_names=column_names,
+                            columns_descriptions=column_descriptions,
+                            values=values)
+    table = _new_table(connection, table_name)
+    table.initialize(columns)
+    table.addData(columns)
+
+    original_file = table.getOriginalFile()
+    table.close()  # when we are done, close.
+    if _tracer is not None:
+        _trace_round_trips(4, sum(np.asarray(v).nbytes for v in values))
+    return _create_table_annotation(connection, original_file)
+
+
+def _batch_to_columns(batch, column_names):
+    """Converts a batch of rows into a list of columns. A batch is either a list of columns,
+    a numpy structured array or a pandas DataFrame with the columns named as column_names"""
+    if hasattr(batch, 'iloc') or (isinstance(batch, np.ndarray) and batch.dtype.names):
+        return [batch[cn] for cn in column_names]
+    return batch
+
+
+def _chunk_batches(batches, column_names, chunk_size):
+    """Yields lists of columns of at most chunk_size rows"""
+    for batch in batches:
+        batch = _batch_to_columns(batch, column_names)
+        for start in range(0, len(batch[0]), chunk_size):
+            yield [c[start:start + chunk_size] for c in batch]
+
+
+@_traced
+def create_annotation_table_streaming(connection, table_name, column_names, column_descriptions, batches,
+                                      schema=None, chunk_size=10000, namespace=None, description=None):
+    """Creates a table annotation appending the rows in chunks of at most chunk_size rows so that
+    large tables never have to be held in memory nor sent in a single message.
+    batches is either an iterable of batches of rows or a single numpy structured array or pandas DataFrame.
+    Every batch can be a list of columns, a numpy structured array or a pandas DataFrame.
+    The column types are inferred once from the first chunk unless a schema is provided as a list
+    with the type of every column (a key of COLUMN_TYPES), string columns being given as ('string', size).
+    Provide a schema if strings in later rows may be longer than the ones in the first chunk.
+    The throughput in rows/s is logged at INFO level.
+    """
+    if hasattr(batches, 'iloc') or (isinstance(batches, np.ndarray) and batches.dtype.names):
+        batches = [batches]
+    chunks = _chunk_batches(batches, column_names, chunk_size)
+
+    try:
+        first_chunk = next(chunks)
+    except StopIteration:
+        raise ValueError('Could not create a table without rows')
+    if schema is None:
+        schema = _get_table_schema(first_chunk)
+    schema = _normalize_schema(schema)
+
+    columns = _create_columns(column_names=column_names,
+                              columns_descriptions=column_descriptions,
+                              schema=schema)
+    table = _new_table(connection, table_name)
+    nr_rows = 0
+    start_time = time.perf_counter()
+    try:
+        table.initialize(columns)
+        for chunk in chain([first_chunk], chunks):
+            for column, (data_type, _), values in zip(columns, schema, chunk):
+                column.values = _to_column_values(values, data_type)
+            table.addData(columns)
+            if _tracer is not None:
+                _trace_round_trips(nbytes=sum(np.asarray(values).nbytes for values in chunk))
+            nr_rows += len(chunk[0])
+        original_file = table.getOriginalFile()
+    finally:
+        table.close()
+        _trace_round_trips(3)  # initialize, getOriginalFile and close
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'Table {table_name}: {nr_rows} rows written in {elapsed:.2f} s '
+                f'({nr_rows / elapsed if elapsed else float("inf"):.0f} rows/s)')
+
+    return _create_table_annotation(connection, original_file)
+
+
+@_traced
 def create_roi(connection, image, shapes):
     """A pass through to create a roi into an image"""
     return _create_roi(connection, image, shapes)
@@ -334,9 +1284,32 @@ def _create_roi(connection, image, shapes):
     for shape in shapes:
         roi.addShape(shape)
     # Save the ROI (saves any linked shapes too)
+    _trace_round_trips()
     return connection.getUpdateService().saveAndReturnObject(roi)
 
 
+@_traced
+def create_rois(connection, image, shapes, batch_size=1000):
+    """Creates many rois into an image saving them in batches of batch_size rois.
+    shapes is a list where every element is either a shape, creating a roi with that single shape,
+    or a list of shapes, creating a roi containing all of them.
+    Returns the ids of the created rois in the same order as shapes"""
+    update_service = connection.getUpdateService()
+    roi_ids = list()
+    for start in range(0, len(shapes), batch_size):
+        rois = list()
+        for roi_shapes in shapes[start:start + batch_size]:
+            roi = model.RoiI()
+            roi.setImage(image._obj)
+            for shape in roi_shapes if isinstance(roi_shapes, (list, tuple)) else [roi_shapes]:
+                roi.addShape(shape)
+            rois.append(roi)
+        roi_ids.extend(roi.getId().getValue() for roi in update_service.saveAndReturnArray(rois))
+        _trace_round_trips()
+
+    return roi_ids
+
+
 def _rgba_to_int(red, green, blue, alpha=255):
     """ Return the color as an Integer in RGBA encoding """
     r = red << 24
@@ -361,6 +1334,40 @@ def _set_shape_properties(shape, name=None,
     shape.setStrokeWidth(LengthI(stroke_width, enums.UnitsLength.PIXEL))
 
 
+def _rgba_to_int_array(colors, size):
+    """Vectorised version of _rgba_to_int. colors is either one (r, g, b, a) color or an array of size colors"""
+    colors = np.broadcast_to(np.asarray(colors, dtype=np.uint32), (size, 4))
+    rgba = (colors[:, 0] << 24) | (colors[:, 1] << 16) | (colors[:, 2] << 8) | colors[:, 3]
+
+    return rgba.astype(np.uint32).view(np.int32)  # convert to signed 32-bit int
+
+
+def _set_shapes_properties(shapes, names=None,
+                           fill_colors=(10, 10, 10, 255),
+                           stroke_colors=(255, 255, 255, 255),
+                           stroke_width=1):
+    """Sets the properties of a list of shapes. Colors are converted all at once and
+    the omero types of repeated values are shared between shapes"""
+    fill_colors = _rgba_to_int_array(fill_colors, len(shapes)).tolist()
+    stroke_colors = _rgba_to_int_array(stroke_colors, len(shapes)).tolist()
+    rints = {c: rtypes.rint(c) for c in set(fill_colors) | set(stroke_colors)}
+    stroke_width = LengthI(stroke_width, enums.UnitsLength.PIXEL)
+    if names is None:
+        names = [None] * len(shapes)
+
+    for shape, name, fill_color, stroke_color in zip(shapes, names, fill_colors, stroke_colors):
+        if name:
+            shape.setTextValue(rtypes.rstring(name))
+        shape.setFillColor(rints[fill_color])
+        shape.setStrokeColor(rints[stroke_color])
+        shape.setStrokeWidth(stroke_width)
+
+
+def _to_list(values, size, dtype):
+    """Broadcasts a scalar or array to size and returns it as a list of python numbers"""
+    return np.broadcast_to(np.asarray(values, dtype=dtype), (size,)).tolist()
+
+
 def create_shape_point(x_pos, y_pos, z_pos, t_pos, point_name=None):
     point = model.PointI()
     point.x = rtypes.rdouble(x_pos)
@@ -425,14 +1432,20 @@ def create_shape_ellipse(x_pos, y_pos, x_radius, y_radius, z_pos, t_pos,
     return ellipse
 
 
+def _encode_points(points):
+    """Encodes a list or (n, 2) array of x, y points in the OMERO points format: 'x1,y1, x2,y2, ...'.
+    All the coordinates are formatted in a single operation"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return ('%.10g,%.10g, ' * len(points) % tuple(points.ravel().tolist()))[:-2]
+
+
 def create_shape_polygon(points_list, z_pos, t_pos,
                          polygon_name=None,
                          fill_color=(10, 10, 10, 255),
                          stroke_color=(255, 255, 255, 255),
                          stroke_width=1):
     polygon = model.PolygonI()
-    points_str = "".join(["".join([str(x), ',', str(y), ', ']) for x, y in points_list])[:-2]
-    polygon.points = rtypes.rstring(points_str)
+    polygon.points = rtypes.rstring(_encode_points(points_list))
     polygon.theZ = rtypes.rint(z_pos)
     polygon.theT = rtypes.rint(t_pos)
     _set_shape_properties(polygon, name=polygon_name,
@@ -450,33 +1463,342 @@ def create_shape_mask(mask_array, x_pos, y_pos, z_pos, t_pos,
     mask.setY(rtypes.rdouble(y_pos))
     mask.setTheZ(rtypes.rint(z_pos))
     mask.setTheT(rtypes.rint(t_pos))
-    mask.setWidth(rtypes.rdouble(mask_array.shape[0]))
-    mask.setHeight(rtypes.rdouble(mask_array.shape[1]))
+    # mask_array is a (y, x) array: rows are the height and columns the width
+    mask.setWidth(rtypes.rdouble(mask_array.shape[1]))
+    mask.setHeight(rtypes.rdouble(mask_array.shape[0]))
     mask.setFillColor(rtypes.rint(_rgba_to_int(*fill_color)))
     if mask_name:
         mask.setTextValue(rtypes.rstring(mask_name))
-    mask_packed = np.packbits(mask_array)  # TODO: raise error when not boolean array
+    mask_packed = np.packbits(np.asarray(mask_array, dtype=bool))
     mask.setBytes(mask_packed.tobytes())
 
     return mask
 
 
+def create_shapes_point(x_pos, y_pos, z_pos, t_pos, point_names=None,
+                        fill_colors=(10, 10, 10, 255),
+                        stroke_colors=(255, 255, 255, 255),
+                        stroke_width=1):
+    """Creates a list of points from arrays of coordinates. z_pos, t_pos and colors can be either
+    a single value for all the points or an array with one value per point"""
+    x_pos = np.asarray(x_pos, dtype=np.float64).ravel()
+    size = len(x_pos)
+    points = list()
+    for x, y, z, t in zip(x_pos.tolist(),
+                          _to_list(y_pos, size, np.float64),
+                          _to_list(z_pos, size, np.int32),
+                          _to_list(t_pos, size, np.int32)):
+        point = model.PointI()
+        point.x = rtypes.rdouble(x)
+        point.y = rtypes.rdouble(y)
+        point.theZ = rtypes.rint(z)
+        point.theT = rtypes.rint(t)
+        points.append(point)
+    _set_shapes_properties(points, names=point_names,
+                           fill_colors=fill_colors,
+                           stroke_colors=stroke_colors,
+                           stroke_width=stroke_width)
+    return points
+
+
+def create_shapes_rectangle(x_pos, y_pos, width, height, z_pos, t_pos,
+                            rectangle_names=None,
+                            fill_colors=(10, 10, 10, 255),
+                            stroke_colors=(255, 255, 255, 255),
+                            stroke_width=1):
+    """Creates a list of rectangles from arrays of coordinates and sizes. See create_shapes_point"""
+    x_pos = np.asarray(x_pos, dtype=np.float64).ravel()
+    size = len(x_pos)
+    rectangles = list()
+    for x, y, w, h, z, t in zip(x_pos.tolist(),
+                                _to_list(y_pos, size, np.float64),
+                                _to_list(width, size, np.float64),
+                                _to_list(height, size, np.float64),
+                                _to_list(z_pos, size, np.int32),
+                                _to_list(t_pos, size, np.int32)):
+        rect = model.RectangleI()
+        rect.x = rtypes.rdouble(x)
+        rect.y = rtypes.rdouble(y)
+        rect.width = rtypes.rdouble(w)
+        rect.height = rtypes.rdouble(h)
+        rect.theZ = rtypes.rint(z)
+        rect.theT = rtypes.rint(t)
+        rectangles.append(rect)
+    _set_shapes_properties(rectangles, names=rectangle_names,
+                           fill_colors=fill_colors,
+                           stroke_colors=stroke_colors,
+                           stroke_width=stroke_width)
+    return rectangles
+
+
+def create_shapes_ellipse(x_pos, y_pos, x_radius, y_radius, z_pos, t_pos,
+                          ellipse_names=None,
+                          fill_colors=(10, 10, 10, 255),
+                          stroke_colors=(255, 255, 255, 255),
+                          stroke_width=1):
+    """Creates a list of ellipses from arrays of coordinates and radii. See create_shapes_point"""
+    x_pos = np.asarray(x_pos, dtype=np.float64).ravel()
+    size = len(x_pos)
+    ellipses = list()
+    for x, y, rx, ry, z, t in zip(x_pos.tolist(),
+                                  _to_list(y_pos, size, np.float64),
+                                  _to_list(x_radius, size, np.float64),
+                                  _to_list(y_radius, size, np.float64),
+                                  _to_list(z_pos, size, np.int32),
+                                  _to_list(t_pos, size, np.int32)):
+        ellipse = model.EllipseI()
+        ellipse.setX(rtypes.rdouble(x))
+        ellipse.setY(rtypes.rdouble(y))
+        ellipse.radiusX = rtypes.rdouble(rx)
+        ellipse.radiusY = rtypes.rdouble(ry)
+        ellipse.theZ = rtypes.rint(z)
+        ellipse.theT = rtypes.rint(t)
+        ellipses.append(ellipse)
+    _set_shapes_properties(ellipses, names=ellipse_names,
+                           fill_colors=fill_colors,
+                           stroke_colors=stroke_colors,
+                           stroke_width=stroke_width)
+    return ellipses
+
+
+def _label_planes(labels, z_pos):
+    """Returns labels as a (z, y, x) array and the z of each of its planes. See create_shapes_mask"""
+    labels = np.asarray(labels)
+    if labels.ndim == 2:
+        return labels[np.newaxis], [z_pos or 0]
+    if z_pos is None:
+        z_pos = 0
+    if np.ndim(z_pos) == 0:
+        return labels, (z_pos + np.arange(labels.shape[0])).tolist()
+    if len(z_pos) != labels.shape[0]:
+        raise ValueError(f'{len(z_pos)} z positions given for {labels.shape[0]} planes')
+    return labels, _to_list(z_pos, labels.shape[0], np.int32)
+
+
+def create_shapes_mask(labels, t_pos=0, z_pos=None, fill_colors=(10, 10, 10, 255), label_names=False):
+    """Creates the masks of every label of a label image, as returned by segment_channel.
+    labels is a (z, y, x) or a (y, x) array, in which case z_pos is the z of its plane (default 0).
+    For a (z, y, x) array, z_pos is either the z of every plane or, if a single value, the z of the first plane,
+    the following planes being at z_pos + 1, z_pos + 2... (default 0)
+    Every label gets one mask per plane it is present in, cropped to its bounding box in that plane.
+    Bounding boxes are found for all labels of a plane at once (scipy.ndimage.find_objects).
+    fill_colors can be a single color or an array with the color of every label (label 1 first).
+    If label_names is True, masks are named after their label.
+    Returns a dictionary with the list of masks of every label"""
+    labels, z_positions = _label_planes(labels, z_pos)
+    nr_labels = int(labels.max(initial=0))
+    fill_colors = _rgba_to_int_array(fill_colors, nr_labels).tolist()
+    rints = {c: rtypes.rint(c) for c in set(fill_colors)}
+    the_t = rtypes.rint(t_pos)
+
+    masks = dict()
+    for plane, z in zip(labels, z_positions):
+        the_z = rtypes.rint(z)
+        for label_index, bounding_box in enumerate(ndi.find_objects(plane, max_label=nr_labels)):
+            if bounding_box is None:
+                continue
+            label = label_index + 1
+            crop = plane[bounding_box] == label
+            mask = model.MaskI()
+            mask.setX(rtypes.rdouble(bounding_box[1].start))
+            mask.setY(rtypes.rdouble(bounding_box[0].start))
+            mask.setWidth(rtypes.rdouble(crop.shape[1]))
+            mask.setHeight(rtypes.rdouble(crop.shape[0]))
+            mask.setTheZ(the_z)
+            mask.setTheT(the_t)
+            mask.setFillColor(rints[fill_colors[label_index]])
+            if label_names:
+                mask.setTextValue(rtypes.rstring(str(label)))
+            mask.setBytes(np.packbits(crop).tobytes())
+            masks.setdefault(label, list()).append(mask)
+
+    return masks
+
+
+def create_rois_from_labels(connection, image, labels, t_pos=0, z_pos=None, fill_colors=(10, 10, 10, 255),
+                            label_names=False, batch_size=1000, shape_type='mask', tolerance=1.0, max_vertices=None):
+    """Creates a roi for every label of a label image, containing its shapes in every plane.
+    shape_type is either 'mask' (see create_shapes_mask) or 'polygon', the simplified outlines of the labels
+    (see create_shapes_polygon_from_labels).
+    Rois are saved in batches of batch_size. Returns a dictionary with the roi id of every label"""
+    if shape_type == 'mask':
+        shapes = create_shapes_mask(labels, t_pos=t_pos, z_pos=z_pos, fill_colors=fill_colors,
+                                    label_names=label_names)
+    elif shape_type == 'polygon':
+        shapes = create_shapes_polygon_from_labels(labels, t_pos=t_pos, z_pos=z_pos, tolerance=tolerance,
+                                                   max_vertices=max_vertices, fill_colors=fill_colors,
+                                                   label_names=label_names)
+    else:
+        raise Exception(f'Shape type {shape_type} is not valid. Use mask or polygon')
+    label_list = sorted(shapes)
+    roi_ids = create_rois(connection, image, [shapes[label] for label in label_list], batch_size=batch_size)
+
+    return dict(zip(label_list, roi_ids))
+
+
+def create_shapes_polygon(points_lists, z_pos, t_pos, polygon_names=None,
+                          fill_colors=(10, 10, 10, 255),
+                          stroke_colors=(255, 255, 255, 255),
+                          stroke_width=1):
+    """Creates a list of polygons from a list of (n, 2) arrays of x, y points. See create_shapes_point"""
+    size = len(points_lists)
+    polygons = list()
+    for points, z, t in zip(points_lists,
+                            _to_list(z_pos, size, np.int32),
+                            _to_list(t_pos, size, np.int32)):
+        polygon = model.PolygonI()
+        polygon.points = rtypes.rstring(_encode_points(points))
+        polygon.theZ = rtypes.rint(z)
+        polygon.theT = rtypes.rint(t)
+        polygons.append(polygon)
+    _set_shapes_properties(polygons, names=polygon_names,
+                           fill_colors=fill_colors,
+                           stroke_colors=stroke_colors,
+                           stroke_width=stroke_width)
+    return polygons
+
+
+def _douglas_peucker(points, bounds, tolerances):
+    """Simplifies many polylines at once with the Douglas-Peucker algorithm. points is the (n, 2) array of
+    the vertices of all the polylines, polyline i going from bounds[i, 0] to bounds[i, 1] (included) and
+    being simplified with tolerances[i]. Every iteration splits all the segments of all the polylines
+    at their farthest vertex, if it is further than the tolerance.
+    Returns a boolean array flagging the vertices kept"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[bounds[:, 0]] = True
+    keep[bounds[:, 1]] = True
+    starts, ends = bounds[:, 0].copy(), bounds[:, 1].copy()
+    segment_tolerances = np.asarray(tolerances, dtype=np.float64)
+    while len(starts):
+        counts = ends - starts - 1
+        split = counts > 0
+        starts, ends, segment_tolerances, counts = starts[split], ends[split], segment_tolerances[split], counts[split]
+        if not len(starts):
+            break
+        segment_ids = np.repeat(np.arange(len(starts)), counts)
+        first_interior = np.cumsum(counts) - counts
+        interior = np.arange(counts.sum()) - np.repeat(first_interior, counts) + np.repeat(starts + 1, counts)
+
+        direction = points[ends] - points[starts]
+        offsets = points[interior] - points[starts][segment_ids]
+        lengths = np.hypot(direction[:, 0], direction[:, 1])[segment_ids]
+        cross = np.abs(direction[segment_ids, 0] * offsets[:, 1] - direction[segment_ids, 1] * offsets[:, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # For closed polylines the first and last vertices are the same: distances are to that vertex
+            distances = np.where(lengths > 0, cross / lengths, np.hypot(offsets[:, 0], offsets[:, 1]))
+
+        max_distances = np.maximum.reduceat(distances, first_interior)
+        is_max = distances == max_distances[segment_ids]
+        farthest = interior[is_max][np.unique(segment_ids[is_max], return_index=True)[1]]
+
+        split = max_distances > segment_tolerances
+        farthest = farthest[split]
+        keep[farthest] = True
+        starts = np.concatenate([starts[split], farthest])
+        ends = np.concatenate([farthest, ends[split]])
+        segment_tolerances = np.tile(segment_tolerances[split], 2)
+
+    return keep
+
+
+def _simplify_contours(contours, tolerance, max_vertices):
+    """Simplifies closed contours with the Douglas-Peucker algorithm. If max_vertices is given, the tolerance
+    of the polygons with more than max_vertices vertices is doubled until they have at most max_vertices"""
+    if not contours:
+        return list()
+    lengths = np.array([len(contour) for contour in contours])
+    bounds = np.stack([np.cumsum(lengths) - lengths, np.cumsum(lengths) - 1], axis=1)
+    points = np.concatenate(contours)
+    contour_ids = np.repeat(np.arange(len(contours)), lengths)
+    tolerances = np.full(len(contours), tolerance or 0, dtype=np.float64)
+
+    keep = _douglas_peucker(points, bounds, tolerances) if tolerance else np.ones(len(points), dtype=bool)
+    while max_vertices:
+        # The first vertex is repeated at the end of the contours
+        too_many = np.bincount(contour_ids[keep], minlength=len(contours)) - 1 > max_vertices
+        if not too_many.any():
+            break
+        tolerances[too_many] = np.where(tolerances[too_many] > 0, tolerances[too_many] * 2, .5)
+        redo = np.isin(contour_ids, np.flatnonzero(too_many))
+        keep[redo] = False
+        keep |= _douglas_peucker(points, bounds[too_many], tolerances[too_many])
+
+    return [points[start:end][keep[start:end]][:-1] for start, end in zip(bounds[:, 0], bounds[:, 1] + 1)]
+
+
+def get_label_contours(labels, tolerance=1.0, max_vertices=None):
+    """Returns the outer contour of every label in a (y, x) label image as a dictionary of (n, 2) arrays
+    of x, y vertices, simplified with the Douglas-Peucker algorithm (see _simplify_contours).
+    Contours are traced on the bounding box of every label, found for all labels at once,
+    and simplified all together"""
+    label_list = list()
+    contours = list()
+    offsets = list()
+    for label_index, bounding_box in enumerate(ndi.find_objects(labels)):
+        if bounding_box is None:
+            continue
+        # Padding so that the contours of labels touching the border of their box are closed
+        crop = np.pad(labels[bounding_box] == label_index + 1, 1)
+        label_list.append(label_index + 1)
+        contours.append(max(find_contours(crop.astype(np.uint8), .5), key=len))
+        offsets.append((bounding_box[1].start - 1, bounding_box[0].start - 1))
+
+    polygons = _simplify_contours(contours, tolerance, max_vertices)
+
+    # (row, column) to (x, y)
+    return {label: polygon[:, ::-1] + offset for label, polygon, offset in zip(label_list, polygons, offsets)}
+
+
+def create_shapes_polygon_from_labels(labels, t_pos=0, z_pos=None, tolerance=1.0, max_vertices=None,
+                                      fill_colors=(10, 10, 10, 0), stroke_colors=(255, 255, 0, 255),
+                                      label_names=False):
+    """Creates the outline polygons of every label of a (z, y, x) or (y, x) label image, one per plane the label
+    is present in. z_pos is the z of the planes as in create_shapes_mask. See get_label_contours.
+    Returns a dictionary with the list of polygons of every label"""
+    labels, z_positions = _label_planes(labels, z_pos)
+    nr_labels = int(labels.max(initial=0))
+    fill_colors = np.broadcast_to(np.asarray(fill_colors), (nr_labels, 4))
+    stroke_colors = np.broadcast_to(np.asarray(stroke_colors), (nr_labels, 4))
+
+    polygons = dict()
+    for plane, z in zip(labels, z_positions):
+        contours = get_label_contours(plane, tolerance=tolerance, max_vertices=max_vertices)
+        plane_labels = list(contours)
+        indexes = np.array(plane_labels, dtype=np.int64) - 1
+        plane_polygons = create_shapes_polygon([contours[label] for label in plane_labels], z, t_pos,
+                                               polygon_names=[str(label) for label in plane_labels]
+                                               if label_names else None,
+                                               fill_colors=fill_colors[indexes],
+                                               stroke_colors=stroke_colors[indexes])
+        for label, polygon in zip(plane_labels, plane_polygons):
+            polygons.setdefault(label, list()).append(polygon)
+
+    return polygons
+
+
 def link_annotation(object_wrapper, annotation_wrapper):
     object_wrapper.linkAnnotation(annotation_wrapper)
 
 
 ###### Image analysis functions #######
 
-def segment_channel(channel, min_distance, sigma, method, hysteresis_levels):
-    """Segment a channel (3D numpy array)"""
+@_traced
+def segment_channel(channel, min_distance, sigma, method, hysteresis_levels, block_shape=None, workers=1, out=None):
+    """Segment a channel (3D numpy array)
+
+    If a block_shape is provided, the channel is processed in overlapping blocks so that volumes larger than
+    memory (eg: a numpy memmap) can be segmented. See _segment_channel_blocked
+    """
+    if block_shape is not None:
+        return _segment_channel_blocked(channel, min_distance, sigma, method, hysteresis_levels,
+                                        block_shape=block_shape, workers=workers, out=out)
+
     threshold = threshold_otsu(channel)
 
     # TODO: Threshold be a sigma passed here
     if sigma:
-        gauss_filtered = gaussian(image=channel,
-                                  multichannel=False,
-                                  sigma=sigma,
-                                  preserve_range=True)
+        # As skimage's gaussian with preserve_range, without its multichannel argument removed from recent versions
+        gauss_filtered = ndi.gaussian_filter(channel.astype(np.float64), sigma=sigma, mode='nearest', truncate=4.0)
     else:
         gauss_filtered = channel
 
@@ -490,11 +1812,10 @@ def segment_channel(channel, min_distance, sigma, method, hysteresis_levels):
         peaks = peak_local_max(gauss_filtered,
                                min_distance=min_distance,
                                threshold_abs=(threshold * .5),
-                               exclude_border=True,
-                               indices=False
+                               exclude_border=True
                                )
         thresholded = np.copy(gauss_filtered)
-        thresholded[peaks] = thresholded.max()
+        thresholded[tuple(peaks.T)] = thresholded.max()
         thresholded = apply_hysteresis_threshold(thresholded,
                                                  low=threshold * hysteresis_levels[0],
                                                  high=threshold * hysteresis_levels[1]
@@ -507,38 +1828,323 @@ def segment_channel(channel, min_distance, sigma, method, hysteresis_levels):
     return label(cleared)
 
 
-def compute_channel_spots_properties(channel, label_channel, pixel_size=None):
-    """Analyzes and extracts the properties of a single channel"""
+def _get_blocks(shape, block_shape, halo=0):
+    """Returns a list of (block, block_with_halo, interior) slices tuples covering shape.
+    interior are the slices of the block relative to block_with_halo"""
+    blocks = list()
+    for starts in product(*[range(0, size, block_size) for size, block_size in zip(shape, block_shape)]):
+        block = tuple(slice(start, min(start + block_size, size))
+                      for start, block_size, size in zip(starts, block_shape, shape))
+        block_with_halo = tuple(slice(max(0, s.start - halo), min(s.stop + halo, size)) for s, size in zip(block, shape))
+        interior = tuple(slice(s.start - h.start, s.stop - h.start) for s, h in zip(block, block_with_halo))
+        blocks.append((block, block_with_halo, interior))
+
+    return blocks
+
+
+def _run_blocks(function, blocks, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, blocks))
+
+
+@_traced
+def _threshold_otsu_blocked(channel, blocks, workers, nbins=256):
+    """Computes the Otsu threshold of the whole channel from a global histogram accumulated block by block.
+    Integer images use one bin per value, as threshold_otsu does"""
+    extrema = _run_blocks(lambda b: (channel[b[0]].min(), channel[b[0]].max()), blocks, workers)
+    min_value = min(e[0] for e in extrema)
+    max_value = max(e[1] for e in extrema)
+    if np.issubdtype(channel.dtype, np.integer):
+        edges = np.arange(int(min_value), int(max_value) + 2) - .5
+    else:
+        edges = np.linspace(float(min_value), float(max_value), nbins + 1)
+    hist = np.sum(_run_blocks(lambda b: np.histogram(channel[b[0]], bins=edges)[0], blocks, workers), axis=0)
+    bin_centers = (edges[:-1] + edges[1:]) / 2
+
+    # Class probabilities and means for all possible thresholds
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    mean1 = np.cumsum(hist * bin_centers) / np.maximum(weight1, 1)
+    mean2 = (np.cumsum((hist * bin_centers)[::-1]) / np.maximum(weight2[::-1], 1))[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+
+    return bin_centers[np.argmax(variance12)]
+
+
+@_traced
+def _label_blocks(get_mask, blocks, structure, out, workers):
+    """Labels the mask returned by get_mask(blocks) for every block, writes the labels into out making them
+    unique across blocks and returns the number of labels.
+    get_mask may return a (mask, seeds) tuple. In that case a boolean array telling which labels
+    contain any seed voxel is returned too"""
+    def label_block(blocks):
+        mask = get_mask(blocks)
+        seeds = None
+        if isinstance(mask, tuple):
+            mask, seeds = mask
+        block_labels, nr_labels = ndi.label(mask, structure=structure)
+        out[blocks[0]] = block_labels
+        seeded_labels = np.unique(block_labels[seeds]) if seeds is not None else None
+        return nr_labels, seeded_labels
+
+    results = _run_blocks(label_block, blocks, workers)
+
+    offset = 0
+    seeded = list()
+    for (block, _, _), (nr_labels, seeded_labels) in zip(blocks, results):
+        if offset:
+            block_labels = out[block]
+            block_labels[block_labels > 0] += offset
+            out[block] = block_labels
+        if seeded_labels is not None:
+            seeded.append(seeded_labels[seeded_labels > 0] + offset)
+        offset += nr_labels
+
+    if seeded:
+        has_seed = np.zeros(offset + 1, dtype=bool)
+        has_seed[np.concatenate(seeded)] = True
+        return offset, has_seed
+    return offset
+
+
+@_traced
+def _merge_labels(labels, nr_labels, block_shape, full_connectivity):
+    """Finds the labels touching across the block borders and returns, for every label,
+    the index of the connected component it belongs to"""
+    edges = list()
+    for axis, block_size in enumerate(block_shape):
+        other_axes = [a for a in range(labels.ndim) if a != axis]
+        # With full connectivity, voxels also touch the diagonal neighbours across the border
+        shifts = list(product((-1, 0, 1), repeat=len(other_axes))) if full_connectivity else [(0,) * len(other_axes)]
+        for border in range(block_size, labels.shape[axis], block_size):
+            before = np.take(labels, border - 1, axis=axis)
+            after = np.take(labels, border, axis=axis)
+            for shift in shifts:
+                before_slices = tuple(slice(max(0, -s), before.shape[i] - max(0, s)) for i, s in enumerate(shift))
+                after_slices = tuple(slice(max(0, s), after.shape[i] - max(0, -s)) for i, s in enumerate(shift))
+                a = before[before_slices]
+                b = after[after_slices]
+                touching = (a > 0) & (b > 0)
+                edges.append(np.stack((a[touching], b[touching])))
+
+    edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), dtype=np.int64)
+    graph = coo_matrix((np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])),
+                       shape=(nr_labels + 1, nr_labels + 1))
+    _, components = connected_components(graph, directed=False)
+
+    return components
+
+
+def _segment_channel_blocked(channel, min_distance, sigma, method, hysteresis_levels,
+                             block_shape=(64, 512, 512), workers=1, out=None):
+    """Segments a channel processing it in blocks of block_shape, in parallel over workers threads.
+    The Otsu threshold is computed from a global histogram and the blocks are read with a halo large enough
+    for the gaussian filter, the local maxima detection and the closing to be computed as on the whole channel.
+    The hysteresis thresholding and the labeling are computed per block and the labels are merged across blocks,
+    so objects spanning several blocks get a single label.
+    out may be provided (eg: an int32 numpy memmap) to hold the labels. It is the only volume written, so with
+    a memmap the memory used is bounded by the blocks.
+    Note: the local maxima detection may differ slightly at block borders from the one of the whole channel
+    as peaks are only compared within a halo.
+    """
+    if method not in ('hysteresis', 'local_max'):
+        raise Exception('A valid segmentation method was not provided')
+    if out is None:
+        out = np.zeros(channel.shape, dtype=np.int32)
+    block_shape = tuple(min(b, s) for b, s in zip(block_shape, channel.shape))
+
+    gaussian_radius = int(4 * sigma + .5) if sigma else 0  # Same truncation as the gaussian filter
+    filter_blocks = _get_blocks(channel.shape, block_shape, halo=gaussian_radius + min_distance)
+    closing_blocks = _get_blocks(channel.shape, block_shape, halo=min_distance)
 
-    ch_properties = list()
+    if method == 'hysteresis':
+        low, high = hysteresis_levels
+    else:
+        threshold = _threshold_otsu_blocked(channel, filter_blocks, workers)
+        low, high = threshold * hysteresis_levels[0], threshold * hysteresis_levels[1]
+
+    def hysteresis_masks(blocks):
+        block, block_with_halo, interior = blocks
+        filtered = channel[block_with_halo]
+        if sigma:
+            filtered = ndi.gaussian_filter(filtered.astype(np.float64), sigma=sigma, mode='nearest', truncate=4.0)
+        low_mask = filtered > low
+        high_mask = filtered > high
+        if method == 'local_max':
+            peaks = peak_local_max(filtered,
+                                   min_distance=min_distance,
+                                   threshold_abs=(threshold * .5),
+                                   exclude_border=True)
+            low_mask[tuple(peaks.T)] = True
+            high_mask[tuple(peaks.T)] = True
+        return low_mask[interior], high_mask[interior]
+
+    # Hysteresis: we keep the connected regions above low containing any voxel above high
+    face_structure = ndi.generate_binary_structure(channel.ndim, 1)
+    nr_labels, has_high = _label_blocks(hysteresis_masks, filter_blocks, face_structure, out, workers)
+    components = _merge_labels(out, nr_labels, block_shape, full_connectivity=False)
+    components_with_high = np.zeros(components.max() + 1, dtype=bool)
+    components_with_high[components[has_high]] = True
+    keep = components_with_high[components]
+    keep[0] = False
+
+    # Closing, computed within out so that no other volume is allocated: bit 0 holds the thresholded mask,
+    # which the blocks read with a halo, and bit 1 the closed mask, which every block only writes in its interior
+    def threshold_block(blocks):
+        out[blocks[0]] = keep[out[blocks[0]]]
+
+    _run_blocks(threshold_block, closing_blocks, workers)
+
+    def close_block(blocks):
+        block, block_with_halo, interior = blocks
+        thresholded = (out[block_with_halo] & 1).astype(bool)
+        out[block] |= closing(thresholded, cube(min_distance))[interior].astype(out.dtype) << 1
+
+    _run_blocks(close_block, closing_blocks, workers)
+
+    # Labeling with full connectivity and removal of the objects touching the border of the volume
+    full_structure = ndi.generate_binary_structure(channel.ndim, channel.ndim)
+    nr_labels = _label_blocks(lambda b: (out[b[0]] & 2).astype(bool), closing_blocks, full_structure, out, workers)
+    components = _merge_labels(out, nr_labels, block_shape, full_connectivity=True)
+    on_border = np.zeros(components.max() + 1, dtype=bool)
+    for axis in range(channel.ndim):
+        for index in (0, channel.shape[axis] - 1):
+            on_border[components[np.take(out, index, axis=axis)]] = True
+    on_border[components[0]] = True  # The background
+
+    new_labels = np.zeros(len(on_border), dtype=out.dtype)
+    new_labels[~on_border] = np.arange(1, np.count_nonzero(~on_border) + 1)
+    relabel = new_labels[components]
+
+    def relabel_block(blocks):
+        out[blocks[0]] = relabel[out[blocks[0]]]
+
+    _run_blocks(relabel_block, closing_blocks, workers)
+
+    return out
+
+
+@_traced
+def compute_channel_spots_measurements(channel, label_channel, pixel_size=None):
+    """Measures all the labeled objects of a channel at once and returns a numpy structured array with,
+    for every label, the label, area, centroid, weighted_centroid, max_intensity, min_intensity and mean_intensity.
+    channel and label_channel are (z, x, y) arrays, as returned by get_intensities for a single channel and time
+    point, and centroids are given in that same (z, x, y) order.
+    If the pixel_size (x, y, z) is provided, volume, centroid_physical and weighted_centroid_physical
+    are added in physical units.
+    """
+    channel = np.asarray(channel)
+    labels = np.asarray(label_channel).ravel()
+
+    # Voxels of the objects sorted by label, so every object is a contiguous run we can reduce at once
+    foreground = np.flatnonzero(labels)
+    foreground = foreground[np.argsort(labels[foreground], kind='stable')]
+    sorted_labels = labels[foreground]
+    starts = np.flatnonzero(np.diff(sorted_labels, prepend=0))
+    intensities = channel.ravel()[foreground]
+    coordinates = np.unravel_index(foreground, channel.shape)
+
+    fields = [('label', np.int64),
+              ('area', np.int64),
+              ('centroid', np.float64, (3,)),
+              ('weighted_centroid', np.float64, (3,)),
+              ('max_intensity', channel.dtype),
+              ('min_intensity', channel.dtype),
+              ('mean_intensity', np.float64)]
+    if pixel_size is not None:
+        fields += [('volume', np.float64),
+                   ('centroid_physical', np.float64, (3,)),
+                   ('weighted_centroid_physical', np.float64, (3,))]
+    measurements = np.zeros(len(starts), dtype=fields)
+    if len(starts) == 0:
+        return measurements
+
+    area = np.diff(np.append(starts, len(sorted_labels)))
+    weights = intensities.astype(np.float64)
+    total_intensity = np.add.reduceat(weights, starts)
+    measurements['label'] = sorted_labels[starts]
+    measurements['area'] = area
+    for axis in range(3):
+        measurements['centroid'][:, axis] = np.add.reduceat(coordinates[axis], starts) / area
+        with np.errstate(invalid='ignore', divide='ignore'):
+            measurements['weighted_centroid'][:, axis] = (np.add.reduceat(coordinates[axis] * weights, starts) /
+                                                          total_intensity)
+    measurements['max_intensity'] = np.maximum.reduceat(intensities, starts)
+    measurements['min_intensity'] = np.minimum.reduceat(intensities, starts)
+    measurements['mean_intensity'] = total_intensity / area
+
+    if pixel_size is not None:
+        scale = np.array((pixel_size[2], pixel_size[0], pixel_size[1]), dtype=np.float64)  # As (z, x, y)
+        measurements['volume'] = area * np.prod(scale)
+        measurements['centroid_physical'] = measurements['centroid'] * scale
+        measurements['weighted_centroid_physical'] = measurements['weighted_centroid'] * scale
+
+    return measurements
+
+
+@_traced
+def compute_channel_spots_properties(channel, label_channel, pixel_size=None):
+    """Analyzes and extracts the properties of a single channel as a list with a dictionary for every label.
+    See compute_channel_spots_measurements.
+    centroid and weighted_centroid are tuples in the (z, x, y) order of the axes of the channel, in pixels.
+    With a pixel_size, volume, centroid_physical and weighted_centroid_physical are in the units of the pixel size"""
 
-    regions = regionprops(label_channel, channel)
+    measurements = compute_channel_spots_measurements(channel, label_channel, pixel_size=pixel_size)
 
-    for region in regions:
-        ch_properties.append({'label': region.label,
-                              'area': region.area,
-                              # XY coordinates are swapped in a numpy array compared to an image
-                              'centroid': (region.centroid[0], region.centroid[1], region.centroid[1]),
-                              'weighted_centroid': (region.weighted_centroid[0], region.weighted_centroid[2], region.weighted_centroid[1]),
-                              'max_intensity': region.max_intensity,
-                              'mean_intensity': region.mean_intensity,
-                              'min_intensity': region.min_intensity
-                              })
+    # Columns are converted at once. The (3,) centroid fields become tuples whatever the numpy version
+    names = measurements.dtype.names
+    columns = [list(map(tuple, measurements[name].tolist())) if measurements[name].ndim > 1
+               else measurements[name].tolist() for name in names]
+    ch_properties = [dict(zip(names, values)) for values in zip(*columns)]
 
     return ch_properties
 
 
-def compute_distances_matrix(positions, sigma, pixel_size=None, remove_mcn=False):
-    """Calculates Mutual Closest Neighbour distances between all channels and returns the values as
-    a list of tuples where the first element is a tuple with the channel combination (ch_A, ch_B) and the second is
-    a list of pairwise measurements where, for every spot s in ch_A:
-    - Positions of s (s_x, s_y, s_z)
-    - Weighted euclidean distance dst to the nearest spot in ch_B, t
-    - Index t_index of the nearest spot in ch_B
-    Like so:
-    [((ch_A, ch_B), [[(s_x, s_y, s_z), dst, t_index],...]),...]
+def _nearest_neighbours(positions_a, positions_b, sigma, scale, remove_mcn):
+    """Computes, for the unordered pair of channels (a, b), the nearest neighbours closer than sigma
+    in both directions using KD-trees. Returns the pairwise distances for (a, b) and for (b, a)"""
+    scaled_a = positions_a * scale
+    scaled_b = positions_b * scale
+    tree_a = cKDTree(scaled_a)
+    tree_b = cKDTree(scaled_b)
+    # Nearest neighbour in b of every spot in a and vice versa. Missing neighbours get infinite distance
+    dist_ab, index_ab = tree_b.query(scaled_a, k=1, distance_upper_bound=sigma)
+    dist_ba, index_ba = tree_a.query(scaled_b, k=1, distance_upper_bound=sigma)
+
+    def select(positions, dist, index, reverse_index):
+        selected = np.flatnonzero(dist < sigma)
+        if remove_mcn:
+            # Keep only the spots that are also the nearest neighbour of their nearest neighbour
+            selected = selected[reverse_index[index[selected]] == selected]
+        return {'coord_A': positions[selected],
+                'dist_3d': dist[selected],
+                'index_A': selected,
+                'index_B': index[selected]}
+
+    return select(positions_a, dist_ab, index_ab, index_ba), select(positions_b, dist_ba, index_ba, index_ab)
+
+
+@_traced
+def compute_distances_matrix(positions, sigma, pixel_size=None, remove_mcn=False, method='kdtree'):
+    """Finds, for every spot of every channel, its nearest neighbour in each of the other channels.
+    Returns a list with a dictionary for every ordered pair of channels (a, b):
+    - channels: the (a, b) tuple
+    - coord_A: the positions of the spots of a having a neighbour in b closer than sigma
+    - dist_3d: the distances to these neighbours
+    - index_A: the indexes of these spots in positions[a]
+    - index_B: the indexes of their nearest neighbours in positions[b]
+    With remove_mcn only the mutual closest neighbours are kept: the spots of a that are also the nearest
+    neighbour in a of their nearest neighbour in b.
+
+    Positions are (z, x, y), as the centroids of compute_channel_spots_measurements, and pixel_size is (x, y, z),
+    as returned by get_pixel_sizes. Coordinates are scaled by the pixel size of their axis, so distances
+    and sigma are in physical units. Without a pixel_size they are in pixels.
+
+    With method='kdtree', the default, the nearest neighbours are found with KD-trees, every pair of channels is
+    computed once for both directions and the values are numpy arrays.
+    With method='cdist' the full distance matrix between every pair of channels is computed and the values
+    are lists.
     """
-    # TODO: Correct documentation
     # Container for results
     distances = list()
 
@@ -557,11 +2163,35 @@ def compute_distances_matrix(positions, sigma, pixel_size=None, remove_mcn=False
         # TODO: log warning
     else:
         pixel_size = np.array(pixel_size)
+    scale = np.array((pixel_size[2], pixel_size[0], pixel_size[1]), dtype=np.float64)  # As (z, x, y)
+
+    if method == 'kdtree':
+        pairs = dict()
+        for a, b in combinations(range(len(positions)), 2):
+            positions_a = np.asarray(positions[a], dtype=np.float64).reshape(-1, 3)
+            positions_b = np.asarray(positions[b], dtype=np.float64).reshape(-1, 3)
+            if len(positions_a) == 0 or len(positions_b) == 0:
+                empty = {'coord_A': np.empty((0, 3)), 'dist_3d': np.empty(0),
+                         'index_A': np.empty(0, dtype=np.intp), 'index_B': np.empty(0, dtype=np.intp)}
+                pairs[(a, b)], pairs[(b, a)] = empty, dict(empty)
+                continue
+            pairs[(a, b)], pairs[(b, a)] = _nearest_neighbours(positions_a, positions_b, sigma, scale, remove_mcn)
+
+        for a, b in channel_permutations:
+            distances.append({'channels': (a, b), **pairs[(a, b)]})
+
+        return distances
+
+    elif method != 'cdist':
+        raise Exception(f'{method} is not a valid method to compute distances')
 
     for a, b in channel_permutations:
         # TODO: Try this
         # TODO: Make explicit arguments of cdist
-        distances_matrix = cdist(positions[a], positions[b], w=pixel_size)
+        # cdist weights the squared coordinate differences
+        positions_a = np.asarray(positions[a], dtype=np.float64).reshape(-1, 3)
+        positions_b = np.asarray(positions[b], dtype=np.float64).reshape(-1, 3)
+        distances_matrix = cdist(positions_a, positions_b, w=scale ** 2)
 
         pairwise_distances = {'channels': (a, b),
                               'coord_A': list(),
@@ -569,8 +2199,8 @@ def compute_distances_matrix(positions, sigma, pixel_size=None, remove_mcn=False
                               'index_A': list(),
                               'index_B': list()
                               }
-        for index_a, (p, d) in enumerate(zip(positions[a], distances_matrix)):
-            if d.min() < sigma:
+        for index_a, (p, d) in enumerate(zip(positions_a, distances_matrix)):
+            if len(d) and d.min() < sigma:
                 # We remove the mutual closest neighbours
                 if remove_mcn and distances_matrix[:, d.argmin()].argmin() != index_a:
                     continue
@@ -0,0 +1,149 @@
+"""Opt-in tracing of the toolbox calls: wall time, server round trips, bytes transferred and size of
+the arrays returned by every call, aggregated into a summary or exported as a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev).
+eg:
+    with trace() as tracer:
+        intensities = toolbox.get_intensities(image, workers=4)
+    print(tracer.report())
+    tracer.save_chrome_trace('trace.json')
+
+When no tracer is set the traced toolbox functions only check a global before running.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+import toolbox
+
+
+class Span(object):
+    """A traced call. Round trips, bytes and allocations are those of the call itself, not of the calls it makes"""
+    __slots__ = ('name', 'thread_id', 'start', 'duration', 'round_trips', 'bytes', 'allocated_bytes')
+
+    def __init__(self, name, thread_id, start):
+        self.name = name
+        self.thread_id = thread_id
+        self.start = start
+        self.duration = None
+        self.round_trips = 0
+        self.bytes = 0
+        self.allocated_bytes = 0
+
+    def add_allocation(self, nbytes):
+        self.allocated_bytes += nbytes
+
+
+class Tracer(object):
+    """Records a Span for every traced call. Counts reported outside of any span, eg: from a thread pool
+    running untraced functions, are kept in an '(untraced)' span"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self.spans = list()
+        self.untraced = Span('(untraced)', None, 0.0)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name):
+        span = Span(name, threading.get_ident(), time.perf_counter() - self._origin)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span.duration = time.perf_counter() - self._origin - span.start
+            with self._lock:
+                self.spans.append(span)
+
+    def _current(self):
+        stack = self._stack()
+        return stack[-1] if stack else self.untraced
+
+    def add_round_trips(self, count=1, nbytes=0):
+        span = self._current()
+        if span is self.untraced:
+            with self._lock:
+                span.round_trips += count
+                span.bytes += nbytes
+        else:
+            span.round_trips += count
+            span.bytes += nbytes
+
+    def add_allocation(self, nbytes):
+        span = self._current()
+        if span is self.untraced:
+            with self._lock:
+                span.allocated_bytes += nbytes
+        else:
+            span.allocated_bytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self.spans = list()
+            self.untraced = Span('(untraced)', None, 0.0)
+
+    def summary(self):
+        """Returns a dictionary with, for every function, the number of calls, the total and maximum
+        wall time in seconds, the round trips, bytes transferred and bytes of the returned arrays"""
+        with self._lock:
+            spans = self.spans + ([self.untraced] if self.untraced.round_trips or self.untraced.allocated_bytes else [])
+        summary = dict()
+        for span in spans:
+            entry = summary.setdefault(span.name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                   'round_trips': 0, 'bytes': 0, 'allocated_bytes': 0})
+            entry['calls'] += 1
+            entry['seconds'] += span.duration or 0.0
+            entry['max_seconds'] = max(entry['max_seconds'], span.duration or 0.0)
+            entry['round_trips'] += span.round_trips
+            entry['bytes'] += span.bytes
+            entry['allocated_bytes'] += span.allocated_bytes
+
+        return summary
+
+    def report(self):
+        """Returns the summary as a text table sorted by total time. Times include the nested calls"""
+        lines = [f'{"function":40s} {"calls":>7s} {"total s":>9s} {"max s":>9s} {"trips":>7s} '
+                 f'{"MB transferred":>15s} {"MB returned":>12s}']
+        for name, entry in sorted(self.summary().items(), key=lambda item: -item[1]['seconds']):
+            lines.append(f'{name:40s} {entry["calls"]:7d} {entry["seconds"]:9.3f} {entry["max_seconds"]:9.3f} '
+                         f'{entry["round_trips"]:7d} {entry["bytes"] / 2 ** 20:15.2f} '
+                         f'{entry["allocated_bytes"] / 2 ** 20:12.2f}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Returns the spans in the Chrome trace event format"""
+        with self._lock:
+            spans = list(self.spans)
+        events = [{'name': span.name,
+                   'ph': 'X',
+                   'ts': span.start * 1e6,
+                   'dur': span.duration * 1e6,
+                   'pid': 0,
+                   'tid': span.thread_id,
+                   'args': {'round_trips': span.round_trips,
+                            'bytes': span.bytes,
+                            'allocated_bytes': span.allocated_bytes}}
+                  for span in spans]
+        return {'traceEvents': sorted(events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+@contextmanager
+def trace(tracer=None):
+    """Traces the toolbox calls within the context with tracer (a new Tracer by default)"""
+    tracer = tracer or Tracer()
+    previous = toolbox.set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        toolbox.set_tracer(previous)